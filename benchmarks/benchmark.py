@@ -0,0 +1,286 @@
+#
+# benchmark.py - time px41cx_utility with synthetic firmware, ROM and BMP files
+#
+#
+# Usage: benchmark.py [-h] [-o OUTPUT] [--scales SCALES] [--repeat REPEAT] [-j JOBS]
+#                     [--versions VERSIONS] [--keep DIR]
+#                     [--baseline BASELINE] [--threshold THRESHOLD]
+#
+#
+# Real firmware and ROM files cannot be distributed, so this generates firmware with
+# the PX41CX magic bytes, ROM map, ROM names, user lines, version string and date
+# tables for both the 0.902 (day table) and 0.903 (month and day table) layouts,
+# together with 8 Kb ROM files and 1 bit 250 x 122 BMPs.
+#
+# Each phase (hex read and write, inspect, ROM decode, splash encode, language
+# detection, a single build) is timed separately, then complete builds of 1, 12 and
+# 1000 firmware variants from a manifest. The best and median of REPEAT runs are
+# written as JSON.
+#
+# With --baseline the results are compared against an earlier JSON output and the
+# exit status is 1 if any result is more than THRESHOLD times slower.
+#
+
+#
+# This program is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software Foundation,
+# either version 3 of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see <https://www.gnu.org/licenses/>.
+#
+import os
+import sys
+import json
+import time
+import random
+import struct
+import argparse
+import platform
+import tempfile
+import statistics
+import contextlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import px41cx_utility as px
+
+ROM_POOL = 24
+# Page and bank of each user ROM in a variant, pages 0-3 and 5 are used by the OS
+VARIANT_PAGES = [(4, 1), (6, 1), (7, 1), (8, 1), (9, 1), (0xa, 1), (0xb, 1), (0xc, 1), (0xd, 1), (0xe, 1), (0xf, 1), (0xf, 2)]
+OS_MAP = [(0, 0, 0, 0), (1, 0, 0, 0), (2, 0, 0, 0), (3, 0, 1, 0), (5, 0, 1, 0), (5, 1, 1, 0)]
+OS_NAMES = ['XNUT0', 'XNUT1', 'XNUT2', 'CXFUN0', 'TIMER', 'CXFUN1']
+VERSION_ADDR = 0x1234
+DATE_ADDR = 0x3000
+MONTH_ADDR = 0x3100
+# Firmware files have a few unprogrammed gaps, matching them keeps the hex records realistic
+HOLES = [(0x7f00, 0x8000), (0xfa00, 0x10000)]
+
+
+def make_firmware(version, language='eng', seed=1):
+    r = random.Random(seed)
+    image = px.FirmwareImage()
+    start = 0
+    for hole_start, hole_end in HOLES + [(px.FIRMWARE_SIZE, px.FIRMWARE_SIZE)]:
+        image.puts(start, r.randbytes(hole_start - start))
+        start = hole_end
+
+    image[0] = px.MAGIC1
+    image[1] = px.MAGIC2
+    image.putsz(VERSION_ADDR, "VER: " + version)
+
+    if version >= '0.903':
+        image.puts(DATE_ADDR, px.DATE_TABLES[language])
+    else:
+        # Day table only, the month tables of every language are elsewhere in the firmware
+        image.puts(DATE_ADDR, px.DAY_TABLES[language])
+        for n, lang in enumerate(px.LANGUAGES):
+            image.puts(MONTH_ADDR + n * 64, px.MONTH_TABLES[lang])
+
+    rom_map = OS_MAP + [(8 + n % 8, 0, 0, n + 1) for n in range(px.ROM_MAP_SIZE - 6)]
+    names = OS_NAMES + ["MOD{:02d}".format(n) for n in range(px.ROM_MAP_SIZE - 6)]
+    for n in range(px.ROM_MAP_SIZE):
+        px.set_rom(image, n, *rom_map[n])
+        image.putsz(px.ROM_NAMES + n * px.NAME_LEN, names[n])
+    for line in range(1, 5):
+        px.set_user_text(image, line, "Line {}".format(line))
+    image[px.SPLASH] = 0xff
+    return image
+
+def make_rom(filename, seed=1):
+    r = random.Random(seed)
+    words = [r.getrandbits(10) for _ in range(px.ROM_WORDS)]
+    with open(filename, "wb") as f:
+        f.write(struct.pack(">{}H".format(px.ROM_WORDS), *words))
+
+def make_bmp(filename, shapes=12, size=60, seed=1):
+    # 1 bit BMP of random filled rectangles up to size pixels, many small shapes give a
+    # splash image too complex to fit without --fit
+    r = random.Random(seed)
+    row_bytes = -(-px.WIDTH//32) * 4
+    pixels = [[0] * px.WIDTH for _ in range(px.HEIGHT)]
+    for _ in range(shapes):
+        x, y = r.randrange(px.WIDTH), r.randrange(px.HEIGHT)
+        w, h = r.randrange(1, size), r.randrange(1, size)
+        for row in pixels[y:y + h]:
+            row[x:x + w] = [1] * len(row[x:x + w])
+
+    rows = b''
+    for row in reversed(pixels):
+        bits = int("".join(map(str, row)), 2) << (row_bytes * 8 - px.WIDTH)
+        rows += bits.to_bytes(row_bytes, 'big')
+
+    offset = 14 + 40 + 8
+    header = b'BM' + struct.pack("<IHHI", offset + len(rows), 0, 0, offset)
+    info = struct.pack("<IiiHHIIiiII", 40, px.WIDTH, px.HEIGHT, 1, 1, 0, len(rows), 2835, 2835, 2, 0)
+    palette = b'\x00\x00\x00\x00\xff\xff\xff\x00'
+    with open(filename, "wb") as f:
+        f.write(header + info + palette + rows)
+
+def make_files(directory, version):
+    os.makedirs(directory, exist_ok=True)
+    files = {'roms': []}
+    for n in range(ROM_POOL):
+        filename = os.path.join(directory, "R{:02d}.ROM".format(n))
+        make_rom(filename, n)
+        files['roms'].append(filename)
+    files['bmp'] = os.path.join(directory, "splash.bmp")
+    make_bmp(files['bmp'])
+    files['complex_bmp'] = os.path.join(directory, "complex.bmp")
+    make_bmp(files['complex_bmp'], shapes=1500, size=6)
+    files['firmware'] = os.path.join(directory, "fw{}.hex".format(version.replace('.', '')))
+    px.save_firmware(make_firmware(version), files['firmware'])
+    return files
+
+def variant_args(files, n, outfile):
+    # All 12 user ROMs, user text, a date language and a splash screen
+    args = {'outfile': outfile, 'merge': False, 'bmpfile': files['bmp'], 'fit': False}
+    for num in range(6, px.ROM_MAP_SIZE):
+        rom = files['roms'][(n + num) % ROM_POOL]
+        page, bank = VARIANT_PAGES[num - 6]
+        args["rom{:02d}".format(num)] = [rom, "{:x}".format(page), str(bank), "0", str(num)]
+    for line in range(1, 5):
+        args['user' + str(line)] = "Variant {} line {}".format(n, line)
+    for lang in px.LANGUAGES:
+        args[lang] = lang == px.LANGUAGES[n % len(px.LANGUAGES)]
+    return args
+
+def write_manifest(files, directory, count):
+    variants = []
+    for n in range(count):
+        entry = variant_args(files, n, "v{:04d}.hex".format(n))
+        variants.append({'outfile': entry['outfile'],
+                         'roms': {key[3:]: entry[key] for key in entry if key.startswith("rom")},
+                         'user': [entry['user' + str(line)] for line in range(1, 5)],
+                         'language': px.LANGUAGES[n % len(px.LANGUAGES)],
+                         'bmpfile': entry['bmpfile']})
+    filename = os.path.join(directory, "manifest{}.json".format(count))
+    with open(filename, "w") as f:
+        json.dump({'variants': variants}, f)
+    return filename
+
+def timed(fn, repeat):
+    times = []
+    with open(os.devnull, "w") as null, contextlib.redirect_stdout(null):
+        for _ in range(repeat):
+            start = time.perf_counter()
+            fn()
+            times.append(time.perf_counter() - start)
+    return {'best': min(times), 'median': statistics.median(times), 'repeat': repeat}
+
+def fresh(image):
+    # A copy without the cached firmware information, as after reading a file
+    image = image.copy()
+    image.info = None
+    px.DATE_OFFSETS.clear()
+    return image
+
+def phase_benchmarks(files, version, repeat):
+    hexfile = files['firmware']
+    base = px.load_firmware(hexfile)
+    outfile = os.path.join(os.path.dirname(hexfile), "out.hex")
+    ba = bytearray(px.PACKED_SIZE)
+
+    def decode_roms():
+        for romfile in files['roms'][:12]:
+            px.read_rom(ba, romfile)
+
+    def build():
+        px.build_firmware(fresh(base), variant_args(files, 0, outfile))
+
+    def full_build():
+        px.main([hexfile, outfile] + cli_args(files))
+
+    phases = [
+        ('read_hex', lambda: px.read_hex(hexfile)),
+        ('write_hex', lambda: px.write_hex(base, outfile)),
+        ('inspect', lambda: px.inspect_firmware(hexfile)),
+        ('decode_rom_x12', decode_roms),
+        ('splash_encode', lambda: px.encode_splash(px.read_splash(files['bmp']))),
+        ('splash_fit', lambda: px.fit_splash(px.read_splash(files['complex_bmp']))),
+        ('detect_firmware', lambda: px.detect_firmware(fresh(base))),
+        ('copy', base.copy),
+        ('build', build),
+        ('full_build', full_build),
+    ]
+    return [dict(name=name, version=version, scale=1, **timed(fn, repeat)) for name, fn in phases]
+
+def cli_args(files):
+    args = variant_args(files, 0, None)
+    argv = ['-b', args['bmpfile'], '-' + next(lang for lang in px.LANGUAGES if args[lang])]
+    for key in sorted(args):
+        if key.startswith("rom"):
+            argv += ['-' + key[3:]] + args[key]
+        elif key.startswith("user"):
+            argv += ['-u' + key[4:], args[key]]
+    return argv
+
+def batch_benchmarks(files, version, scales, repeat, jobs):
+    base = px.load_firmware(files['firmware'])
+    results = []
+    for count in scales:
+        manifest = write_manifest(files, os.path.dirname(files['firmware']), count)
+        # Larger batches are only run once, they already average over many variants
+        result = timed(lambda: px.build_batch(base, manifest, jobs), repeat if count < 100 else 1)
+        result['per_variant'] = result['best'] / count
+        results.append(dict(name='batch', version=version, scale=count, jobs=jobs, **result))
+    return results
+
+def compare(results, baseline, threshold):
+    # Results more than threshold times slower than the baseline
+    previous = {(r['name'], r['version'], r['scale']): r['best'] for r in baseline['results']}
+    slower = []
+    for r in results:
+        old = previous.get((r['name'], r['version'], r['scale']))
+        if old and r['best'] > old * threshold:
+            slower.append({'name': r['name'], 'version': r['version'], 'scale': r['scale'],
+                           'baseline': old, 'best': r['best'], 'ratio': r['best'] / old})
+    return slower
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark px41cx_utility with synthetic firmware.')
+    parser.add_argument('-o','--output',type=str,help="JSON output file (default standard output)")
+    parser.add_argument('--scales',type=str,default="1,12,1000",help="Numbers of variants to build (default 1,12,1000)")
+    parser.add_argument('--repeat',type=int,default=5,help="Runs of each benchmark (default 5)")
+    parser.add_argument('-j','--jobs',type=int,default=1,help="Number of processes for batch builds")
+    parser.add_argument('--versions',type=str,default="0.902,0.903",help="Firmware versions to generate (default 0.902,0.903)")
+    parser.add_argument('--keep',type=str,metavar='DIR',help="Generate files in DIR and keep them")
+    parser.add_argument('--baseline',type=str,help="Earlier JSON output to compare against")
+    parser.add_argument('--threshold',type=float,default=1.25,help="Slowdown ratio reported as a regression (default 1.25)")
+    args = vars(parser.parse_args(argv))
+
+    versions = args['versions'].split(",")
+    scales = [int(n) for n in args['scales'].split(",") if n]
+
+    with contextlib.ExitStack() as stack:
+        directory = args['keep'] or stack.enter_context(tempfile.TemporaryDirectory())
+        os.makedirs(directory, exist_ok=True)
+        results = []
+        for version in versions:
+            files = make_files(os.path.join(directory, version), version)
+            results += phase_benchmarks(files, version, args['repeat'])
+            results += batch_benchmarks(files, version, scales, args['repeat'], args['jobs'])
+
+    report = {'python': platform.python_version(), 'platform': platform.platform(),
+              'numpy': px.have_numpy(), 'cpus': os.cpu_count(), 'results': results}
+
+    status = 0
+    if args['baseline']:
+        with open(args['baseline']) as f:
+            report['regressions'] = compare(results, json.load(f), args['threshold'])
+        status = 1 if report['regressions'] else 0
+
+    out = json.dumps(report, indent=2)
+    if args['output']:
+        with open(args['output'], "w") as f:
+            f.write(out + "\n")
+    else:
+        print(out)
+    return status
+
+if __name__ == '__main__':
+    sys.exit(main())
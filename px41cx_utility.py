@@ -16,14 +16,39 @@
 #                          [-15 romfile page bank bankgroup modgroup]
 #                          [-16 romfile page bank bankgroup modgroup]
 #                          [-17 romfile page bank bankgroup modgroup]
+#                          [--mod MODFILE]
 #                          [-u1 "custom string line 1"]
 #                          [-u2 "custom string line 2"]
 #                          [-u3 "custom string line 3"}
 #                          [-u4 "custom string line 4"]
-#                          [-b BMPFILE]
+#                          [-b BMPFILE] [--fit]
 #                          [-eng | -fre | -spa | -ger | -ita | -por]
+#                          [--manifest MANIFEST] [-j JOBS]
+#                          [--cache DIR] [--cache-size MB] [--stats] [--json]
+#                          [--profile [{table,json}]] [--no-memory] [--library DB]
+#                          [--checksum {warn,fix,error,ignore}] [--verify]
+#                          [--watch] [--interval SECONDS]
 #                          infile [outfile]
 #
+#        px41cx_utility.py scan [-j JOBS] [-f {jsonl,csv}] [-o OUTPUT]
+#                               [--pattern PATTERN] [--summary FILE] [--verify] paths [paths ...]
+#
+#        px41cx_utility.py extract [-o OUTPUT] [-s SLOTS] [-j JOBS] [--pattern PATTERN]
+#                                  paths [paths ...]
+#
+#        px41cx_utility.py diff [-o PATCH] [--json] base target
+#        px41cx_utility.py patch base patch outfile
+#
+#        px41cx_utility.py allocate [--modules FILE] [--firmware FIRMWARE] [--library DB]
+#                                   [-n LIMIT] [--json] [modules ...]
+#
+#        px41cx_utility.py serve [--host HOST] [-p PORT] [--unix PATH] [--root DIR] [-j JOBS]
+#                                [--base-cache MB] [--rom-cache MB]
+#
+#        px41cx_utility.py library [-d DATABASE] index [-j JOBS] [--pattern PATTERN] paths [paths ...]
+#        px41cx_utility.py library [-d DATABASE] find [--xrom XROM] [--function FUNCTION]
+#                                  [--sha256 SHA256] [-n LIMIT] [--json] [term]
+#
 #
 # The PX41CX firmware includes space for 18 x 4Kb word ROMs from 0 to 17. Locations
 # 0 through 5 are reserved for the 41CX operating system ROMs. ROMs 6 through 17 are
@@ -32,16 +57,61 @@
 # For each required ROM location specify a ROM file, 41CX page, bank, bank group and
 # module group.
 #
+# Multi-page modules can be loaded from MOD1/MOD2 files (--mod), all the pages of a module
+# are read in one pass and loaded into free ROM locations with their page and bank hints
+# and a module group of their own.
+#
 # Custom information can also be specified which will be displayed in the PX41CX
 # Info menu.
 #
 # A simple splash screen can also be added from a monochrome (1 bit) BMP. The screen
-# resolution is 250 x 122 pixels.
+# resolution is 250 x 122 pixels. Images too complex to fit the splash screen space can
+# be simplified (--fit) by merging the shortest runs of pixels.
 # 
 # By default the new ROM options replace all existing firmware ROMs (6-17) in the
 # outfile firmware. The merge option (-m or --merge) merges/replaces the new ROMs
 # with the existing ROMs in the infile firmware.
 #
+# Files ending in .bin are read and written as raw binary firmware images instead of
+# Intel HEX.
+#
+# A JSON or TOML manifest (--manifest) can be used to build many firmware variants
+# from one infile which is only read once. Each variant can optionally be built in
+# a separate process (-j or --jobs).
+#
+# The scan command audits many firmware files or directories of firmware files in
+# parallel, writing the information for each file as JSON lines or CSV and a summary of
+# the versions and modules found.
+#
+# The time and peak memory (traced with tracemalloc) of each phase of a build can be
+# printed as a table or JSON (--profile).
+#
+# The library command keeps an SQLite index of ROM files with the XROM number, module
+# and function names from the function address table, page 4 and bank switching hints
+# and SHA-256 hashes. Builds can take the ROM names from the index (--library).
+#
+# The extract command writes the ROMs loaded in firmware files back to .ROM files named
+# from the ROM names, each distinct ROM is only written once.
+#
+# The diff command lists the regions that differ between two firmware files and can
+# write a compact patch which the patch command applies to the base firmware to rebuild
+# the target exactly.
+#
+# The allocate command chooses the ROM locations, pages, banks, bank groups and module
+# groups for a set of modules, or explains why they cannot be loaded together.
+#
+# The header and HP-41 checksum of each ROM are checked as it is loaded, a bad checksum
+# can be reported (the default), fixed (--checksum fix) or stop the build.
+#
+# The serve command runs a local HTTP service that builds firmware for JSON requests,
+# keeping recently used base firmware and decoded ROMs in memory between builds.
+#
+# With --watch the outfile (or every manifest variant) is rebuilt whenever an input file
+# changes, applying again only the part of the build that uses the changed file.
+#
+# Decoded ROM files can be kept in a cache directory (--cache) shared between runs and
+# batch processes, keyed by the SHA-256 of the ROM file contents.
+#
 
 #
 # Copyright (c) 2024 Darren Hosking @calculatorclique https://github.com/diemheych
@@ -59,8 +129,24 @@
 # this program. If not, see <https://www.gnu.org/licenses/>.
 #
 import os
+import re
+import sys
+import csv
+import fnmatch
+import functools
+import json
+import struct
+import hashlib
+import time
+import bisect
+import binascii
 import argparse
-from intelhex import IntelHex
+import contextlib
+from collections import namedtuple
+
+# NumPy, tempfile and concurrent.futures are imported where first used to keep
+# importing this module fast, NumPy is optional, see numpy_loaded()
+numpy = None
 
 ROM_MAP = 0xf800
 ROM_MAP_SIZE = 18
@@ -69,18 +155,33 @@ ROM_NAMES = 0xf848
 # ROM name length including null
 NAME_LEN = 7
 ROM_LOCATION = [0x8000, 0x9400, 0xab00, 0xbc00, 0xd000, 0xe400, 0x10000, 0x11400, 0x12800, 0x13c00, 0x15000, 0x16400, 0x18000, 0x19400, 0x1a800, 0x1bc00, 0x1d000, 0x1e400]
+ROM_LOCATION_903 = [0x8000, 0x9400, 0xab00, 0xbc00, 0xd000, 0xe400, 0x10030, 0x11430, 0x12830, 0x13c30, 0x15030, 0x16430, 0x18000, 0x19400, 0x1a800, 0x1bc00, 0x1d000, 0x1e400]
 #USER1 = 0xf926
 USER1 = 0xf8c6
 USER2 = USER1 + 0x20
 USER3 = USER2 + 0x20
 USER4 = USER3 + 0x20
+# .ROM files hold 4096 10-bit words as big endian 16-bit values, the firmware packs
+# the low 8 bits of every word followed by the high 2 bits of 4 words per byte
+ROM_WORDS = 4096
+ROM_FILE_SIZE = 8192
+PACKED_SIZE = 5120
+HIGH_PACK = [bytes((b & 3) << s for b in range(256)) for s in (0, 2, 4, 6)]
+HIGH_UNPACK = [bytes((b >> s) & 3 for b in range(256)) for s in (0, 2, 4, 6)]
+# Sum of the 4 high 2 bit values in a packed byte, for the HP-41 page checksum which is
+# held in the last word of the page
+HIGH_SUM = bytes(sum((b >> s) & 3 for s in (0, 2, 4, 6)) for b in range(256))
+XROM_MAX = 31
 SPLASH = 0x1f800
 MAGIC1 = 0x0c
 MAGIC2 = 0x94
 IMAGE_SIZE = 2048
 WIDTH = 250
 HEIGHT = 122
+SPLASH_RUN = re.compile('0+|1+')
+FIRMWARE_SIZE = SPLASH + IMAGE_SIZE
 FW_VERSION = b'VER: '
+LANGUAGES = ['eng', 'fre', 'spa', 'ger', 'ita', 'por']
 DATE_ENG = b'JAN\x00FEB\x00MAR\x00APR\x00MAY\x00JUN\x00JUL\x00AUG\x00SEP\x00OCT\x00NOV\x00DEC\x00SUN\x00MON\x00TUE\x00WED\x00THU\x00FRI\x00SAT\x00'
 DAY_ENG = b'SUN\x00MON\x00TUE\x00WED\x00THU\x00FRI\x00SAT\x00'
 MONTH_ENG = b'JAN\x00FEB\x00MAR\x00APR\x00MAY\x00JUN\x00JUL\x00AUG\x00SEP\x00OCT\x00NOV\x00DEC\x00'
@@ -99,6 +200,97 @@ MONTH_ITA = b'GEN\x00FEB\x00MAR\x00APR\x00MAG\x00GIU\x00LUG\x00AGO\x00SET\x00OTT
 DATE_POR = b'JAN\x00FEV\x00MAR\x00ABR\x00MAI\x00JUN\x00JUL\x00AGO\x00SET\x00OCT\x00NOV\x00DEZ\x00DOM\x00SEG\x00TER\x00QUA\x00QUI\x00SEX\x00SAB\x00'
 DAY_POR = b'DOM\x00SEG\x00TER\x00QUA\x00QUI\x00SEX\x00SAB\x00'
 MONTH_POR = b'JAN\x00FEV\x00MAR\x00ABR\x00MAI\x00JUN\x00JUL\x00AGO\x00SET\x00OCT\x00NOV\x00DEZ\x00'
+LANGUAGE_NAMES = {'eng': 'English', 'fre': 'French', 'spa': 'Spanish', 'ger': 'German', 'ita': 'Italian', 'por': 'Portuguese'}
+DATE_TABLES = {'eng': DATE_ENG, 'fre': DATE_FRE, 'spa': DATE_SPA, 'ger': DATE_GER, 'ita': DATE_ITA, 'por': DATE_POR}
+DAY_TABLES = {'eng': DAY_ENG, 'fre': DAY_FRE, 'spa': DAY_SPA, 'ger': DAY_GER, 'ita': DAY_ITA, 'por': DAY_POR}
+MONTH_TABLES = {'eng': MONTH_ENG, 'fre': MONTH_FRE, 'spa': MONTH_SPA, 'ger': MONTH_GER, 'ita': MONTH_ITA, 'por': MONTH_POR}
+DAY_LANGUAGE = {table: lang for lang, table in DAY_TABLES.items()}
+DATE_SEARCH = re.compile(b'|'.join(re.escape(t) for t in list(MONTH_TABLES.values()) + list(DAY_TABLES.values())))
+# Date table address and type found for each firmware version string, checked before a full scan
+DATE_OFFSETS = {}
+
+# Only these parts of the hex file are decoded to inspect firmware: the magic bytes, ROM map,
+# names, user text and splash screen, then VERSION_SPAN bytes from the version string and the
+# date table. The low area holding the OS is decoded only when those are not found
+HEX_OFFSET_RECORD = (':02000002', ':02000004')
+INSPECT_REGIONS = [(0, 2), (ROM_MAP, ROM_LOCATION_903[6]), (SPLASH, SPLASH + 1)]
+INSPECT_LOW = (0, ROM_LOCATION[0])
+VERSION_SPAN = 32
+DATE_SPAN = len(DATE_ENG)
+
+class PX41CXError(Exception):
+    pass
+
+class SplashError(PX41CXError):
+    pass
+
+class AllocationError(PX41CXError):
+    pass
+
+# HP-41 ROM pages start with the XROM number and function count followed by the function
+# address table (FAT), 2 words per function. ENROM1-4 select a bank of a bank switched page.
+FAT_MAX = 64
+ENROM = {0x100: 1, 0x180: 2, 0x140: 3, 0x1c0: 4}
+# Pages a module page can be allocated to for each placement, in order of preference.
+# Pages 6 and 7 are used by the printer and HP-IL on a 41CX so they are tried last.
+# Upper pages follow the lower page of the same module and ordered pages the previous page.
+ALLOC_PAGES = [8, 9, 10, 11, 12, 13, 14, 15, 6, 7]
+PLACEMENT_PAGES = {'any': ALLOC_PAGES, 'page4': [4], 'lower': [8, 10, 12, 14], 'upper': [9, 11, 13, 15],
+                   'even': [8, 10, 12, 14], 'odd': [9, 11, 13, 15], 'ordered': ALLOC_PAGES}
+# Firmware is compared in blocks of DIFF_BLOCK bytes, patch files start with PATCH_MAGIC
+DIFF_BLOCK = 64
+PATCH_MAGIC = b'PX41CX-PATCH-1\n'
+# A ROM cache directory is scanned when its running size passes the limit, and every
+# CACHE_SCAN_STORES stores to count entries written by other processes. Entries are then
+# removed until it is below CACHE_LOW_WATER of the limit so scans stay infrequent.
+CACHE_SCAN_STORES = 256
+CACHE_LOW_WATER = 0.9
+# MOD1/MOD2 module files are a header followed by the pages, each page has its name, ID,
+# page placement, page group, bank, bank group, RAM, write protect and FAT flags then the
+# 4096 words packed 4 to 5 bytes least significant bit first. Pages 0-f are fixed.
+MOD_FORMATS = (b'MOD1', b'MOD2')
+MOD_HEADER = struct.Struct('<5s50s10s20s50s100s200s255s7B32s')
+MOD_PAGE = struct.Struct('<20s9s7B5120s32s')
+MOD_PLACEMENTS = {0x1f: 'any', 0x2f: 'lower', 0x3f: 'upper', 0x4f: 'even', 0x5f: 'odd', 0x6f: 'ordered'}
+# The build server streams responses SERVE_CHUNK bytes at a time and keeps the latency of
+# the last SERVE_LATENCIES builds for its metrics
+SERVE_CHUNK = 64 * 1024
+SERVE_LATENCIES = 1000
+MOD_LANE = {v: int.from_bytes(bytes([v]) * (ROM_WORDS // 4), 'little') for v in (0x03, 0x0c, 0x0f, 0x30, 0x3f, 0xc0)}
+LIBRARY_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS roms (path TEXT PRIMARY KEY, mtime REAL, size INTEGER, sha256 TEXT, words_sha256 TEXT,
+                                 xrom INTEGER, functions INTEGER, name TEXT, page4 INTEGER, banks TEXT, error TEXT,
+                                 checksum INTEGER, problems TEXT);
+CREATE TABLE IF NOT EXISTS functions (path TEXT, number INTEGER, name TEXT, mcode INTEGER);
+CREATE INDEX IF NOT EXISTS roms_sha256 ON roms (sha256);
+CREATE INDEX IF NOT EXISTS roms_xrom ON roms (xrom);
+CREATE INDEX IF NOT EXISTS functions_path ON functions (path);
+CREATE INDEX IF NOT EXISTS functions_name ON functions (name COLLATE NOCASE);
+'''
+
+FirmwareInfo = namedtuple('FirmwareInfo', ['version', 'date_addr', 'language', 'fw903plus'])
+RomEntry = namedtuple('RomEntry', ['rom', 'page', 'bank', 'bankgroup', 'modgroup', 'name', 'checksum'], defaults=(None,))
+FirmwareReport = namedtuple('FirmwareReport', ['file', 'version', 'roms', 'user', 'language', 'splash'])
+ModulePage = namedtuple('ModulePage', ['roms', 'placement', 'group'], defaults=(0,))
+ModRom = namedtuple('ModRom', ['name', 'packed'])
+Module = namedtuple('Module', ['name', 'pages'])
+SlotAssignment = namedtuple('SlotAssignment', ['slot', 'rom', 'page', 'bank', 'bankgroup', 'modgroup'])
+FirmwareDiff = namedtuple('FirmwareDiff', ['runs', 'regions', 'base_digest', 'target_digest', 'ranges', 'start_addr'])
+ProfileRecord = namedtuple('ProfileRecord', ['variant', 'phase', 'seconds', 'peak'])
+
+def have_numpy():
+    global numpy
+    if numpy is None:
+        try:
+            import numpy
+        except ImportError:
+            numpy = False
+    return numpy is not False
+
+def numpy_loaded():
+    # NumPy is only used once something else has imported it, importing it to decode a
+    # few ROMs or a splash screen takes far longer than the pure Python paths
+    return have_numpy() if 'numpy' in sys.modules else bool(numpy)
 
 def set_rom(hex, rom, page, bank, bankgroup, modgroup):
     hex[ROM_MAP + ROM_MAP_ENTRY * rom + 0] = page
@@ -109,8 +301,8 @@ def set_rom(hex, rom, page, bank, bankgroup, modgroup):
 def get_rom(hex, rom):
     return hex[ROM_MAP + ROM_MAP_ENTRY * rom + 0],hex[ROM_MAP + ROM_MAP_ENTRY * rom + 1],hex[ROM_MAP + ROM_MAP_ENTRY * rom + 2], hex[ROM_MAP + ROM_MAP_ENTRY * rom + 3]
 
-def print_rom(hex, rom):
-    print("ROM[","{:02d}".format(rom),"]: Page: ","{:01x}".format(hex[ROM_MAP + ROM_MAP_ENTRY * rom + 0])," Bank: ",hex[ROM_MAP + ROM_MAP_ENTRY * rom + 1]+1," Bank Group: ",hex[ROM_MAP + ROM_MAP_ENTRY * rom + 2]," Mod Group: ","{:02d}".format(hex[ROM_MAP + ROM_MAP_ENTRY * rom + 3])," ",get_name(hex, rom),sep="")
+def print_rom(entry):
+    print("ROM[","{:02d}".format(entry.rom),"]: Page: ","{:01x}".format(entry.page)," Bank: ",entry.bank," Bank Group: ",entry.bankgroup," Mod Group: ","{:02d}".format(entry.modgroup)," ",entry.name," bad checksum" if entry.checksum is False else "",sep="")
 #    print("ROM[","{:02d}".format(rom),"]: Page: ","{:02d}".format(hex[ROM_MAP + ROM_MAP_ENTRY * rom + 0])," Bank: ",hex[ROM_MAP + ROM_MAP_ENTRY * rom + 1]," Group: ",hex[ROM_MAP + ROM_MAP_ENTRY * rom + 2]," ",get_name(hex, hex[ROM_MAP + ROM_MAP_ENTRY * rom + 0]),sep="")
 
 def get_name(hex, num):
@@ -119,391 +311,2458 @@ def get_name(hex, num):
     else:
         return hex.getsz(ROM_NAMES + num * NAME_LEN).decode('utf-8')
 
-def read_rom(barr, filename):
-    loc = 0
+def get_rom_location(image):
+    if detect_firmware(image).version == 'VER: 0.903':
+        return ROM_LOCATION_903
+    return ROM_LOCATION
+
+def date_table_at(data, addr):
+    # Returns (language, fw903plus) for a day or month+day table at addr
+    lang = DAY_LANGUAGE.get(bytes(data[addr + 48:addr + 76]))
+    if lang and data[addr:addr + 48] == MONTH_TABLES[lang]:
+        return lang, True
+    lang = DAY_LANGUAGE.get(bytes(data[addr:addr + 28]))
+    if lang and (addr < 48 or data[addr - 48:addr] != MONTH_TABLES[lang]):
+        return lang, False
+    return None, False
+
+def detect_firmware(image):
+    # Version string and date table in one pass over the image, cached until the image changes
+    if image.info is not None and image.info[0] == image.writes:
+        return image.info[1]
+
+    version = None
+    if (addr := image.find(FW_VERSION)) != -1:
+        version = image.getsz(addr).decode('utf-8')
+
+    data = image.data
+    date_addr = -1
+    lang = None
+    fw903plus = False
+
+    if (known := DATE_OFFSETS.get(version)) is not None:
+        lang, fw903plus = date_table_at(data, known[0])
+        if lang is not None and fw903plus == known[1]:
+            date_addr = known[0]
+        else:
+            lang = None
+
+    if lang is None:
+        dates = {}
+        days = {}
+        for match in DATE_SEARCH.finditer(data):
+            day_lang = DAY_LANGUAGE.get(match.group())
+            if day_lang is None:
+                continue
+            pos = match.start()
+            days.setdefault(day_lang, pos)
+            if pos >= 48 and data[pos - 48:pos] == MONTH_TABLES[day_lang]:
+                dates.setdefault(day_lang, pos - 48)
+        for found, fw903plus in ((dates, True), (days, False)):
+            lang = next((l for l in LANGUAGES if l in found), None)
+            if lang is not None:
+                date_addr = found[lang]
+                DATE_OFFSETS[version] = (date_addr, fw903plus)
+                break
+
+    info = FirmwareInfo(version, date_addr, lang, fw903plus)
+    image.info = (image.writes, info)
+    return info
+
+def decode_rom(rom):
+    if len(rom) < ROM_FILE_SIZE:
+        raise ValueError("ROM image too short")
+
+    if numpy_loaded():
+        words = numpy.frombuffer(rom, dtype='>u2', count=ROM_WORDS)
+        high = ((words >> 8) & 3).astype(numpy.uint8).reshape(-1, 4)
+        packed = high[:, 0] | (high[:, 1] << 2) | (high[:, 2] << 4) | (high[:, 3] << 6)
+        return words.astype(numpy.uint8).tobytes() + packed.tobytes()
+
+    high = rom[0:ROM_FILE_SIZE:2]
+    packed = 0
+    for n in range(4):
+        packed |= int.from_bytes(high[n::4].translate(HIGH_PACK[n]), 'big')
+    return bytes(rom[1:ROM_FILE_SIZE:2]) + packed.to_bytes(ROM_WORDS // 4, 'big')
+
+def encode_rom(barr):
+    if len(barr) < PACKED_SIZE:
+        raise ValueError("Packed ROM image too short")
+
+    high = bytearray(ROM_WORDS)
+    for n in range(4):
+        high[n::4] = barr[ROM_WORDS:PACKED_SIZE].translate(HIGH_UNPACK[n])
+    rom = bytearray(ROM_FILE_SIZE)
+    rom[0::2] = high
+    rom[1::2] = barr[0:ROM_WORDS]
+    return bytes(rom)
+
+def rom_checksum(packed):
+    # Words 0-4094 summed with end around carry, negated
+    if numpy_loaded():
+        page = numpy.frombuffer(packed, dtype=numpy.uint8, count=PACKED_SIZE)
+        low = int(page[:ROM_WORDS - 1].sum(dtype=numpy.int64))
+        high = int(numpy.frombuffer(packed[ROM_WORDS:PACKED_SIZE].translate(HIGH_SUM), dtype=numpy.uint8).sum(dtype=numpy.int64))
+    else:
+        low = sum(packed[0:ROM_WORDS - 1])
+        high = sum(packed[ROM_WORDS:PACKED_SIZE].translate(HIGH_SUM))
+    total = low + 256 * (high - (packed[PACKED_SIZE - 1] >> 6))
+    total = total % 1023 or (1023 if total else 0)
+    return -total & 0x3ff
+
+def rom_word(packed, n):
+    return packed[n] | (packed[ROM_WORDS + n // 4] >> 2 * (n % 4) & 3) << 8
 
+def check_rom(packed):
+    # Problems with the header and checksum of a packed page
+    problems = []
+    if rom_word(packed, 0) > XROM_MAX or rom_word(packed, 1) > FAT_MAX:
+        problems.append("bad header")
+    if rom_checksum(packed) != rom_word(packed, ROM_WORDS - 1):
+        problems.append("bad checksum")
+    return problems
+
+def fix_rom_checksum(packed):
+    checksum = rom_checksum(packed)
+    packed[ROM_WORDS - 1] = checksum & 0xff
+    packed[PACKED_SIZE - 1] = packed[PACKED_SIZE - 1] & 0x3f | (checksum >> 8) << 6
+
+def read_rom(barr, filename, cache=None):
+    # Decodes the first 8 Kb of the file into barr, returns the length of the file
     try:
         f = open(filename, "rb")
     except:
-        print("Error opening ROM file:",filename)
-        exit(1)
+        raise PX41CXError("Error opening ROM file: " + filename)
         
-    rom = bytearray(f.read())
+    rom = f.read()
     f.close()
 
-    for x in range(256):
-        for y in range(0, 32, 2):
-            low = rom[x * 32 + y + 1]
-            barr[loc] = int(low)
-            loc += 1
-
-    for x in range(64):
-        for y in range(0, 128, 8):
-            high = (rom[x * 128 + y + 6] & 3) << 6
-            high |= (rom[x * 128 + y + 4] & 3) << 4
-            high |= (rom[x * 128 + y + 2] & 3) << 2
-            high |= (rom[x * 128 + y + 0] & 3)
-            barr[loc] = int(high)
-            loc += 1
-
-
-def access_bit(data, num):
-    base = int(num // 8)
-    shift = 7 - int(num % 8)
-    return (data[base] >> shift) & 0x1
-
-
-rom_map = [[0 for _ in range(ROM_MAP_ENTRY)] for _ in range(ROM_MAP_SIZE)]
-
-parser = argparse.ArgumentParser(description='Update ROMs and options in PX41CX Firmware.')
-parser.add_argument('infile')
-parser.add_argument('outfile',nargs='?')
-parser.add_argument('-m','--merge',action='store_true',help="Merge with existing firmware ROMs")
-parser.add_argument('-06',dest='rom06',nargs=5,type=str,metavar=('romfile','page','bank','bankgroup','modgroup'))
-parser.add_argument('-07',dest='rom07',nargs=5,type=str,metavar=('romfile','page','bank','bankgroup','modgroup'))
-parser.add_argument('-08',dest='rom08',nargs=5,type=str,metavar=('romfile','page','bank','bankgroup','modgroup'))
-parser.add_argument('-09',dest='rom09',nargs=5,type=str,metavar=('romfile','page','bank','bankgroup','modgroup'))
-parser.add_argument('-10',dest='rom10',nargs=5,type=str,metavar=('romfile','page','bank','bankgroup','modgroup'))
-parser.add_argument('-11',dest='rom11',nargs=5,type=str,metavar=('romfile','page','bank','bankgroup','modgroup'))
-parser.add_argument('-12',dest='rom12',nargs=5,type=str,metavar=('romfile','page','bank','bankgroup','modgroup'))
-parser.add_argument('-13',dest='rom13',nargs=5,type=str,metavar=('romfile','page','bank','bankgroup','modgroup'))
-parser.add_argument('-14',dest='rom14',nargs=5,type=str,metavar=('romfile','page','bank','bankgroup','modgroup'))
-parser.add_argument('-15',dest='rom15',nargs=5,type=str,metavar=('romfile','page','bank','bankgroup','modgroup'))
-parser.add_argument('-16',dest='rom16',nargs=5,type=str,metavar=('romfile','page','bank','bankgroup','modgroup'))
-parser.add_argument('-17',dest='rom17',nargs=5,type=str,metavar=('romfile','page','bank','bankgroup','modgroup'))
-parser.add_argument('-u1',dest='user1',type=str,help="Info menu configurable text line 1")
-parser.add_argument('-u2',dest='user2',type=str,help="Info menu configurable text line 2")
-parser.add_argument('-u3',dest='user3',type=str,help="Info menu configurable text line 3")
-parser.add_argument('-u4',dest='user4',type=str,help="Info menu configurable text line 4")
-parser.add_argument('-b',dest='bmpfile',type=str,help="BMP file for splash screen" )
-group = parser.add_mutually_exclusive_group()
-group.add_argument("-eng", action="store_true",help="Set date strings to English")
-group.add_argument("-fre", action="store_true",help="Set date strings to French")
-group.add_argument("-spa", action="store_true",help="Set date strings to Spanish")
-group.add_argument("-ger", action="store_true",help="Set date strings to German")
-group.add_argument("-ita", action="store_true",help="Set date strings to Italian")
-group.add_argument("-por", action="store_true",help="Set date strings to Portuguese")
-
-
-args = vars(parser.parse_args())
-arg_count = len(args)
-
-try:
-    ih = IntelHex(args['infile'])
-except:
-    print("Error reading hex file:",args['infile'])
-    exit(1)
-
-if ih[0] != MAGIC1 and ih[1] != MAGIC2:
-    print("Error:",args['infile']," does not look like PX41CX firmware")
-    exit(1)
-
-
-if (arg_count - list(args.values()).count(None) == 1) or (not args['outfile'] and not args['bmpfile']):
-    print("PX41CX Firmware:",args['infile'])
-    if (version := ih.find(FW_VERSION)) != -1:
-        print(ih.getsz(version).decode('utf-8'))
+    try:
+        if cache is not None:
+            barr[0:PACKED_SIZE] = cache.lookup(rom, filename)
+        else:
+            barr[0:PACKED_SIZE] = decode_rom(rom)
+    except ValueError:
+        raise PX41CXError("Error ROM file too short: " + filename)
+    return len(rom)
 
-    for a in range(ROM_MAP_SIZE):
-        page, bank, group, modgroup = get_rom(ih, a)
-        if page != 255:
-            print_rom(ih, a)
-    if ih.getsz(USER1).decode('unicode_escape').isprintable():
-        print("User 1: '",ih.getsz(USER1).decode('unicode_escape'),"'",sep="")
-    else:
-        print("User 1: '",repr(ih.getsz(USER1))[2:-1],"'",sep="")
-    if ih.getsz(USER2).decode('unicode_escape').isprintable():
-        print("User 2: '",ih.getsz(USER2).decode('unicode_escape'),"'",sep="")
-    else:
-        print("User 2: '",repr(ih.getsz(USER2))[2:-1],"'",sep="")
-    if ih.getsz(USER3).decode('unicode_escape').isprintable():
-        print("User 3: '",ih.getsz(USER3).decode('unicode_escape'),"'",sep="")
-    else:
-        print("User 3: '",repr(ih.getsz(USER3))[2:-1],"'",sep="")
-    if ih.getsz(USER4).decode('unicode_escape').isprintable():
-        print("User 4: '",ih.getsz(USER4).decode('unicode_escape'),"'",sep="")
-    else:
-        print("User 4: '",repr(ih.getsz(USER4))[2:-1],"'",sep="")
-    if ih.find(DATE_ENG) != -1:
-        date_fmt = "English"
-    elif ih.find(DATE_FRE) != -1:
-        date_fmt = "French"
-    elif ih.find(DATE_SPA) != -1:
-        date_fmt = "Spanish"
-    elif ih.find(DATE_GER) != -1:
-        date_fmt = "German"
-    elif ih.find(DATE_ITA) != -1:
-        date_fmt = "Italian"
-    elif ih.find(DATE_POR) != -1:
-        date_fmt = "Portuguese"
-    elif ih.find(DAY_ENG) != -1:
-        date_fmt = "English"
-    elif ih.find(DAY_FRE) != -1:
-        date_fmt = "French"
-    elif ih.find(DAY_SPA) != -1:
-        date_fmt = "Spanish"
-    elif ih.find(DAY_GER) != -1:
-        date_fmt = "German"
-    elif ih.find(DAY_ITA) != -1:
-        date_fmt = "Italian"
-    elif ih.find(DAY_POR) != -1:
-        date_fmt = "Portuguese"
-    else:
-        date_fmt = "Unknown"
-    print("Date Format: ",date_fmt)
-    exit(0)
+def rom_name(filename):
+    return "{:6.6}".format(os.path.basename(filename).rsplit('.',1)[0])
 
-newrom = IntelHex()
+class CacheStats:
+    label = "Cache"
 
-ba = bytearray(b'\0' * 5120)
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
 
-if (version := ih.find(FW_VERSION)) != -1:
-    ver = ih.getsz(version).decode('utf-8')
-    if ver == 'VER: 0.903':
-        ROM_LOCATION = [0x8000, 0x9400, 0xab00, 0xbc00, 0xd000, 0xe400, 0x10030, 0x11430, 0x12830, 0x13c30, 0x15030, 0x16430, 0x18000, 0x19400, 0x1a800, 0x1bc00, 0x1d000, 0x1e400]
+    def add_stats(self, stats):
+        self.hits += stats['hits']
+        self.misses += stats['misses']
+        self.evictions += stats['evictions']
 
-changed = False
+    def reset_stats(self):
+        self.hits = self.misses = self.evictions = 0
 
-for key in args:
-    if args[key] and key.startswith("rom"):
-        num = int(key[-2:])
-        romfilename = args[key][0]
-        read_rom(ba, romfilename)
-        romfilename = os.path.basename(args[key][0])
-        newrom.frombytes(ba, offset=ROM_LOCATION[num])
-        ih.merge(newrom, overlap="replace")
-        try:
-            rom_map[num][0] = int(args[key][1],16)
-            rom_map[num][1] = int(args[key][2]) - 1
-            rom_map[num][2] = int(args[key][3])
-            rom_map[num][3] = int(args[key][4])
-            if rom_map[num][0] < 4 or rom_map[num][0] == 5:
-                print("Error, OS page",rom_map[num][0],"selected")
-                exit(1)
-        except ValueError:
-            print("Invalid argument:",-num," ".join(args[key]))
-            exit(1)
-        changed = True
-        romname = "{:6.6}".format(romfilename.rsplit('.',1)[0])
-        name_addr = ROM_NAMES + num * NAME_LEN
-        ih.putsz(name_addr, romname)
-    
-rom_nonzero = [i for i in rom_map if any(i)]
-unique_map = [list(x) for x in set(tuple(x) for x in rom_nonzero)]
-
-if changed and len(rom_nonzero) > len(unique_map):
-    print("Duplicate page map - no file output")
-    exit(1)
-else:
-    if changed:
-        for n in range(6, ROM_MAP_SIZE):
-            if not args['merge'] and not any(rom_map[n]):
-                set_rom(ih, n, 255, 255, 255, 255)
-#                name_addr = ROM_NAMES + rom_map[n][0] * NAME_LEN
-                name_addr = ROM_NAMES + n * NAME_LEN
-                ih.putsz(name_addr, "EMPTY ")
-            else:
-               if any(rom_map[n]):
-                   set_rom(ih, n, *rom_map[n])
-    else:
-        print("No ROM changes")
+    def print_stats(self):
+        print(self.label + ":",self.hits,"hits,",self.misses,"misses,",self.evictions,"evictions")
 
+class RomCache(CacheStats):
+    # Decoded ROM pages stored by SHA-256 of the raw .ROM file. Each entry is the packed
+    # page followed by JSON metadata, written to a temporary file and renamed into place
+    # so concurrent builds never see a partial entry. Least recently used entries are
+    # removed once the directory grows beyond max_size bytes, keeping a running size
+    # rather than scanning the directory for every entry stored.
+    label = "ROM cache"
 
-if args['user1'] != None:
-    info = args['user1']
-    ih.putsz(USER1, "{:31.31}".format(info))
-    changed = True
+    def __init__(self, directory, max_size=64 * 1024 * 1024):
+        self.directory = directory
+        self.max_size = max_size
+        self.size = None
+        self.stores = 0
+        self.reset_stats()
+        os.makedirs(directory, exist_ok=True)
 
-if args['user2'] != None:
-    info = args['user2']
-    ih.putsz(USER2, "{:31.31}".format(info))
-    changed = True
+    def entry_path(self, key):
+        return os.path.join(self.directory, key + ".pxrom")
 
-if args['user3'] != None:
-    info = args['user3']
-    ih.putsz(USER3, "{:31.31}".format(info))
-    changed = True
+    def lookup(self, rom, filename=""):
+        key = hashlib.sha256(rom).hexdigest()
+        path = self.entry_path(key)
+        try:
+            with open(path, "rb") as f:
+                packed = f.read(PACKED_SIZE)
+            if len(packed) == PACKED_SIZE:
+                os.utime(path)
+                self.hits += 1
+                return packed
+        except OSError:
+            pass
 
-if args['user4'] != None:
-    info = args['user4']
-    ih.putsz(USER4, "{:31.31}".format(info))
-    changed = True
+        self.misses += 1
+        packed = decode_rom(rom)
+        meta = {'name': rom_name(filename), 'file': os.path.basename(filename), 'size': len(rom)}
+        self.store(key, packed + json.dumps(meta).encode('utf-8'))
+        return packed
 
-if args['eng'] or args['fre'] or args['spa'] or args['ger'] or args['ita'] or args['por']:
-    fw903plus = False
-    lang = 0
-
-    if (date_addr := ih.find(DATE_ENG)) != -1:
-        fw903plus = True
-        lang = 1
-    elif (date_addr := ih.find(DATE_FRE)) != -1:
-        fw903plus = True
-        lang = 2
-    elif (date_addr := ih.find(DATE_SPA)) != -1:
-        fw903plus = True
-        lang = 3
-    elif (date_addr := ih.find(DATE_GER)) != -1:
-        fw903plus = True
-        lang = 4
-    elif (date_addr := ih.find(DATE_ITA)) != -1:
-        fw903plus = True
-        lang = 5
-    elif (date_addr := ih.find(DATE_POR)) != -1:
-        fw903plus = True
-        lang = 6
-    elif (date_addr := ih.find(DAY_ENG)) != -1:
-        lang = 1
-    elif (date_addr := ih.find(DAY_FRE)) != -1:
-        lang = 2
-    elif (date_addr := ih.find(DAY_SPA)) != -1:
-        lang = 3
-    elif (date_addr := ih.find(DAY_GER)) != -1:
-        lang = 4
-    elif (date_addr := ih.find(DAY_ITA)) != -1:
-        lang = 5
-    elif (date_addr := ih.find(DAY_POR)) != -1:
-        lang = 6
-    else:
-        pass
+    def metadata(self, key):
+        try:
+            with open(self.entry_path(key), "rb") as f:
+                return json.loads(f.read()[PACKED_SIZE:].decode('utf-8'))
+        except (OSError, ValueError):
+            return None
 
-    if args['eng'] and lang:
-        print("Set language: English")
-        if fw903plus:
-            ih.puts(date_addr, DATE_ENG)
-            changed = True
-        elif (month_addr := ih.find(MONTH_ENG)) != -1:
-            ih.puts(date_addr, DAY_ENG)
-            changed = True
+    def store(self, key, entry):
+        import tempfile
+        try:
+            fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                f.write(entry)
+            os.replace(tmp, self.entry_path(key))
+        except OSError:
+            return
+        self.stores += 1
+        if self.size is not None:
+            self.size += len(entry)
+        if self.size is None or self.size > self.max_size or self.stores % CACHE_SCAN_STORES == 0:
+            self.evict()
 
-    if args['fre'] and lang:
-        print("Set language: French")
-        if fw903plus:
-            ih.puts(date_addr, DATE_FRE)
-            changed = True
-        elif (month_addr := ih.find(MONTH_FRE)) != -1:
-            ih.puts(date_addr, DAY_FRE)
-            changed = True
+    def evict(self):
+        entries = []
+        total = 0
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".pxrom"):
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, entry.path))
+                total += st.st_size
+        if total > self.max_size:
+            for mtime, size, path in sorted(entries):
+                try:
+                    os.remove(path)
+                    self.evictions += 1
+                except OSError:
+                    pass
+                total -= size
+                if total <= self.max_size * CACHE_LOW_WATER:
+                    break
+        self.size = total
 
-    if args['spa'] and lang:
-        print("Set language: Spanish")
-        if fw903plus:
-            ih.puts(date_addr, DATE_SPA)
-            changed = True
-        elif (month_addr := ih.find(MONTH_SPA)) != -1:
-            ih.puts(date_addr, DAY_SPA)
-            changed = True
+class MemoryCache(CacheStats):
+    # Least recently used values kept in memory up to max_size bytes as measured by sizeof,
+    # the newest value is always kept. lookup() lets it stand in for a RomCache.
 
-    if args['ger'] and lang:
-        print("Set language: German")
-        if fw903plus:
-            ih.puts(date_addr, DATE_GER)
-            changed = True
-        elif (month_addr := ih.find(MONTH_GER)) != -1:
-            ih.puts(date_addr, DAY_GER)
-            changed = True
+    def __init__(self, max_size=16 * 1024 * 1024, sizeof=len, label="Memory cache"):
+        from collections import OrderedDict
+        self.entries = OrderedDict()
+        self.max_size = max_size
+        self.sizeof = sizeof
+        self.label = label
+        self.size = 0
+        self.reset_stats()
 
-    if args['ita'] and lang:
-        print("Set language: Italian")
-        if fw903plus:
-            ih.puts(date_addr, DATE_ITA)
-            changed = True
-        elif (month_addr := ih.find(MONTH_ITA)) != -1:
-            ih.puts(date_addr, DAY_ITA)
-            changed = True
+    def get(self, key, load):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key][0]
 
-    if args['por'] and lang:
-        print("Set language: Portuguese")
-        if fw903plus:
-            ih.puts(date_addr, DATE_POR)
-            changed = True
-        elif (month_addr := ih.find(MONTH_POR)) != -1:
-            ih.puts(date_addr, DAY_POR)
-            changed = True
-    if not changed:
-        print("Error: Date strings not found")
+        self.misses += 1
+        value = load()
+        size = self.sizeof(value)
+        self.entries[key] = (value, size)
+        self.size += size
+        while self.size > self.max_size and len(self.entries) > 1:
+            _, (_, size) = self.entries.popitem(last=False)
+            self.size -= size
+            self.evictions += 1
+        return value
 
-if args['bmpfile']:
-    filename = args['bmpfile']
+    def lookup(self, rom, filename=""):
+        return self.get(hashlib.sha256(rom).digest(), lambda: decode_rom(rom))
 
+
+def read_splash(filename):
     try:
         f = open(filename, "rb")
     except:
-        print("Error opening BMP file:",filename)
-        exit(1)
+        raise PX41CXError("Error opening BMP file: " + filename)
 
-    bmp = bytearray(f.read())
+    bmp = f.read()
     f.close()
 
     if bmp[0] != 0x42 or bmp[1] != 0x4d:
-        print("Error not a BMP file:",filename)
-        exit(1)
+        raise PX41CXError("Error not a BMP file: " + filename)
 
     if bmp[0x1c] != 1:
-        print("Error BMP depth not 1:",filename)
-        exit(1)
+        raise PX41CXError("Error BMP depth not 1: " + filename)
+
+    try:
+        return splash_runs(bmp)
+    except ValueError:
+        raise PX41CXError("Error BMP file too short: " + filename)
 
+def splash_runs(bmp):
+    # Returns (first colour, run lengths) for each display row from the top, the BMP
+    # rows are stored bottom up and only the first WIDTH x HEIGHT pixels are used
     offset = bmp[11] * 256 + bmp[10]
     width = bmp[19] * 256 + bmp[18]
-    width_pad = -(-width//32) * 32
-    height = bmp[23] * 256 + bmp[22]
+    row_bytes = -(-width//32) * 4
+    inverted = bmp[offset-2]
+    starts = [offset + (r-1) * row_bytes for r in range(HEIGHT, 0, -1)]
+    if starts[0] + 32 > len(bmp):
+        raise ValueError("BMP image too short")
+
+    runs = []
+    if numpy_loaded():
+        frame = numpy.frombuffer(bmp, dtype=numpy.uint8)[numpy.array(starts)[:, None] + numpy.arange(32)]
+        bits = numpy.unpackbits(frame, axis=1)[:, :WIDTH]
+        if inverted:
+            bits ^= 1
+        # Run boundaries for the whole frame, every row starts at 0 and ends at WIDTH
+        edges = numpy.ones((HEIGHT, WIDTH + 1), dtype=bool)
+        edges[:, 1:WIDTH] = bits[:, 1:] != bits[:, :-1]
+        cols = numpy.flatnonzero(edges) % (WIDTH + 1)
+        lengths = numpy.diff(cols)
+        lengths = lengths[lengths > 0].tolist()
+        counts = edges.sum(axis=1) - 1
+        colours = bits[:, 0].tolist()
+        n = 0
+        for r, count in enumerate(counts.tolist()):
+            runs.append((colours[r], lengths[n:n + count]))
+            n += count
+        return runs
 
-# Display is 250x122
+    mask = (1 << WIDTH) - 1 if inverted else 0
+    for start in starts:
+        row = "{:0{}b}".format((int.from_bytes(bmp[start:start + 32], 'big') >> 6) ^ mask, WIDTH)
+        runs.append((int(row[0]), [len(run) for run in SPLASH_RUN.findall(row)]))
+    return runs
+
+def pad_splash(total_bytes):
+    # Size after the display driver padding of up to 10 (0, 0xfa) pairs, a final
+    # single 0 is written when only one byte is left
+    for r in range(10):
+        if total_bytes >= IMAGE_SIZE - 1:
+            return total_bytes
+        total_bytes += 2
+    return total_bytes
+
+def splash_size(runs):
+    return pad_splash(sum(1 + len(row) for colour, row in runs))
+
+def encode_splash(runs):
+    rle = bytearray()
+    for colour, row in runs:
+        rle.append(colour)
+        rle.extend(row)
+    total_bytes = min(len(rle), IMAGE_SIZE)
 
     rleimg = bytearray(b'\x00' * IMAGE_SIZE)
-    inverted = bmp[offset-2]
-    total_bytes = 0
-    for r in range(HEIGHT,0,-1):
-        pixel_count = 0
-        last_colour = 123
-        for c in range(WIDTH):
-            colour = access_bit(bmp, 8 * offset + (r-1) * width_pad + c)
-            if inverted:
-                if colour:
-                    colour = 0
-                else:
-                    colour = 1
-            if colour != last_colour:
-                if pixel_count > 0:
-                    rleimg[total_bytes] = pixel_count
-                    total_bytes += 1
-                    if total_bytes >= IMAGE_SIZE:
+    rleimg[0:total_bytes] = rle[0:total_bytes]
+    padded = pad_splash(total_bytes)
+    rleimg[total_bytes + 1:padded:2] = b'\xfa' * ((padded - total_bytes) // 2)
+    return rleimg, padded
+
+def merge_runs(colour, row, length):
+    # Runs of up to length pixels take the colour of their neighbours
+    row = list(row)
+    if len(row) > 1 and row[0] <= length:
+        colour ^= 1
+        row[1] += row[0]
+        del row[0]
+    merged = [row[0]]
+    i = 1
+    while i < len(row):
+        if row[i] <= length:
+            merged[-1] += sum(row[i:i + 2])
+            i += 2
+        else:
+            merged.append(row[i])
+            i += 1
+    return colour, merged
+
+def fit_splash(runs):
+    # Merge ever longer short runs until the encoded image fits, returns the runs and
+    # the longest run length merged (0 if the image already fits)
+    for length in range(WIDTH):
+        if length:
+            runs = [merge_runs(colour, row, length) for colour, row in runs]
+        if splash_size(runs) < IMAGE_SIZE:
+            return runs, length
+    return runs, length
+
+
+class FirmwareImage:
+    # Firmware held as one contiguous bytearray plus a sorted list of [start, end)
+    # address ranges present in the hex file, unused bytes read as padding
+
+    def __init__(self, size=FIRMWARE_SIZE, padding=0xff):
+        self.data = bytearray([padding]) * size
+        self.ranges = []
+        self.padding = padding
+        self.start_addr = None
+        self.writes = 0
+        self.info = None
+        self.partial = False
+
+    def copy(self):
+        image = FirmwareImage(0, self.padding)
+        image.data = self.data[:]
+        image.ranges = [list(r) for r in self.ranges]
+        if self.start_addr:
+            image.start_addr = self.start_addr.copy()
+        image.writes = self.writes
+        image.info = self.info
+        return image
+
+    def mark(self, start, end):
+        self.writes += 1
+        if end > len(self.data):
+            self.data.extend([self.padding] * (end - len(self.data)))
+        ranges = self.ranges
+        i = bisect.bisect_left(ranges, [start])
+        if i > 0 and ranges[i - 1][1] >= start:
+            i -= 1
+        j = i
+        while j < len(ranges) and ranges[j][0] <= end:
+            start = min(start, ranges[j][0])
+            end = max(end, ranges[j][1])
+            j += 1
+        ranges[i:j] = [[start, end]]
+
+    def used(self, start, end):
+        i = bisect.bisect_right(self.ranges, [start, float('inf')]) - 1
+        return i >= 0 and self.ranges[i][0] <= start and end <= self.ranges[i][1]
+
+    def __getitem__(self, addr):
+        return self.data[addr] if addr < len(self.data) else self.padding
+
+    def __setitem__(self, addr, value):
+        self.mark(addr, addr + 1)
+        self.data[addr] = value
+
+    def puts(self, addr, s):
+        if isinstance(s, str):
+            s = s.encode('latin1')
+        self.mark(addr, addr + len(s))
+        self.data[addr:addr + len(s)] = s
+
+    def putsz(self, addr, s):
+        self.puts(addr, s)
+        self[addr + len(s)] = 0
+
+    def gets(self, addr, length):
+        if not self.used(addr, addr + length):
+            raise ValueError("Bad access at 0x%X: not enough data" % addr)
+        return bytes(self.data[addr:addr + length])
+
+    def getsz(self, addr):
+        end = self.data.find(0, addr)
+        if end == -1 or not self.used(addr, end + 1):
+            raise ValueError("Bad access at 0x%X: not enough data to read zero-terminated string" % addr)
+        return bytes(self.data[addr:end])
+
+    def find(self, sub, start=None, end=None):
+        # Matches must lie within a single used range, as for IntelHex.find()
+        for seg_start, seg_end in self.ranges:
+            seg_start = max(seg_start, start or 0)
+            seg_end = seg_end if end is None else min(seg_end, end)
+            if seg_start < seg_end and (i := self.data.find(sub, seg_start, seg_end)) != -1:
+                return i
+        return -1
+
+
+def hex_field(text, pos, start, end):
+    return int(text[pos + start:pos + end], 16)
+
+def hex_segments(text):
+    # (first, end, offset) text positions of the data records in each extended address
+    # segment, found without splitting the text. Records that are not data are trimmed
+    # from the ends, so the records between are expected to be data in address order.
+    # Returns None if an address record is not valid
+    starts = []
+    for tag in HEX_OFFSET_RECORD:
+        pos = text.find(tag)
+        while pos != -1:
+            starts.append(pos)
+            pos = text.find(tag, pos + 1)
+    starts.sort()
+
+    segments = []
+    first = 0
+    offset = 0
+    for pos in starts + [len(text)]:
+        end = pos
+        while first < end and text[first + 7:first + 9] != '00':
+            first = text.find(':', first + 1, end)
+            if first == -1:
+                first = end
+        while end > first and text[(last := text.rfind(':', first, end)) + 7:last + 9] != '00':
+            end = last
+        if first < end:
+            segments.append((first, end, offset))
+        if pos < len(text):
+            try:
+                value = hex_field(text, pos, 9, 13)
+            except ValueError:
+                return None
+            offset = value << 16 if text[pos + 8] == '4' else value * 16
+            first = text.find(':', pos + 1)
+            if first == -1:
+                first = len(text)
+    return segments
+
+def hex_region_records(text, segments, regions):
+    # (offset, position) of the data records covering regions, found by bisection within
+    # each segment. Returns None if the records are not in address order
+    selected = set()
+    try:
+        for first, end, offset in segments:
+            for start, stop in regions:
+                lo, hi = first, end
+                found = -1
+                while lo < hi:
+                    mid = (lo + hi) // 2
+                    pos = text.find(':', mid, hi)
+                    if pos == -1:
+                        hi = mid
+                    elif offset + hex_field(text, pos, 3, 7) + hex_field(text, pos, 1, 3) <= start:
+                        lo = pos + 1
+                    else:
+                        found = pos
+                        hi = mid
+                # The records either side of those selected are checked for order as well
+                last = -1
+                if found > first:
+                    last = offset + hex_field(text, text.rfind(':', first, found), 3, 7)
+                pos = found
+                while pos != -1:
+                    addr = offset + hex_field(text, pos, 3, 7)
+                    if addr < last or text[pos + 7:pos + 9] != '00':
+                        return None
+                    if addr >= stop:
                         break
-                if c == 0:
-                    rleimg[total_bytes] = colour
-                    total_bytes += 1
-                pixel_count = 1
-                last_colour = colour
+                    selected.add((offset, pos))
+                    last = addr
+                    pos = text.find(':', pos + 1, end)
+    except (ValueError, IndexError):
+        return None
+    return sorted(selected, key=lambda r: r[1])
+
+def hex_find(text, segments, sub):
+    # Address of the first sub lying within one data record, or -1
+    target = binascii.hexlify(sub).decode().upper()
+    firsts = [s[0] for s in segments]
+    pos = text.find(target)
+    while pos != -1:
+        rec = text.rfind(':', 0, pos)
+        data = rec + 9
+        i = bisect.bisect_right(firsts, rec) - 1
+        try:
+            if (i >= 0 and rec < segments[i][1] and text[rec + 7:rec + 9] == '00' and pos >= data and
+                    (pos - data) % 2 == 0 and pos + len(target) <= data + 2 * hex_field(text, rec, 1, 3)):
+                return segments[i][2] + hex_field(text, rec, 3, 7) + (pos - data) // 2
+        except ValueError:
+            pass
+        pos = text.find(target, pos + 1)
+    return -1
+
+def hex_record_bytes(s):
+    try:
+        if s[0] != ':':
+            raise ValueError
+        rec = binascii.unhexlify(s[1:])
+    except (ValueError, binascii.Error):
+        raise ValueError("Invalid hex record")
+    if len(rec) < 5 or len(rec) != rec[0] + 5:
+        raise ValueError("Invalid hex record length")
+    if sum(rec) & 0xff:
+        raise ValueError("Hex record checksum error")
+    return rec
+
+def add_hex_ranges(image, ranges):
+    ranges = sorted(image.ranges + ranges)
+    image.ranges = []
+    for r in ranges:
+        if image.ranges and image.ranges[-1][1] > r[0]:
+            raise ValueError("Hex data overlaps at address 0x%X" % r[0])
+        if image.ranges and image.ranges[-1][1] == r[0]:
+            image.ranges[-1][1] = r[1]
+        else:
+            image.ranges.append(list(r))
+
+def read_hex_records(image, text, records):
+    # Decodes the data records at the (offset, position) pairs from hex_region_records()
+    data = image.data
+    ranges = []
+    for offset, pos in records:
+        end = text.find('\n', pos)
+        try:
+            rec = hex_record_bytes(text[pos:end if end != -1 else len(text)].strip())
+        except ValueError as e:
+            raise ValueError("%s at line %d" % (e, text.count('\n', 0, pos) + 1))
+        addr = offset + (rec[1] << 8 | rec[2])
+        end = addr + rec[0]
+        if end > len(data):
+            data.extend([image.padding] * (end - len(data)))
+        data[addr:end] = rec[4:-1]
+        if ranges and ranges[-1][1] == addr:
+            ranges[-1][1] = end
+        else:
+            ranges.append([addr, end])
+    add_hex_ranges(image, ranges)
+
+def read_hex_detect(image, text, segments, done):
+    # After INSPECT_REGIONS: the version string, then the date table at the address known
+    # for that version. The low area is decoded when either is not found there
+    def decode(regions):
+        records = hex_region_records(text, segments, regions)
+        if records is None:
+            return False
+        read_hex_records(image, text, [r for r in records if r not in done])
+        done.update(records)
+        return True
+
+    addr = hex_find(text, segments, FW_VERSION)
+    if addr == -1 or not decode([(addr, addr + VERSION_SPAN)]):
+        return decode([INSPECT_LOW])
+    try:
+        version = image.getsz(addr).decode('utf-8')
+    except (ValueError, UnicodeDecodeError):
+        return decode([INSPECT_LOW])
+    known = DATE_OFFSETS.get(version)
+    if known is None or not decode([(known[0] - 48, known[0] + DATE_SPAN)]):
+        return decode([INSPECT_LOW])
+    lang, fw903plus = date_table_at(image.data, known[0])
+    if lang is None or fw903plus != known[1]:
+        return decode([INSPECT_LOW])
+    return True
+
+def read_hex(filename, regions=None, detect=False):
+    # With regions only the records overlapping those (start, end) ranges are decoded,
+    # with detect also the version string and date table as read_hex_detect()
+    image = FirmwareImage()
+
+    with open(filename, "r") as f:
+        text = f.read()
+
+    if regions is not None and (segments := hex_segments(text)) is not None:
+        records = hex_region_records(text, segments, regions)
+        if records is not None:
+            read_hex_records(image, text, records)
+            if not detect or read_hex_detect(image, text, segments, set(records)):
+                image.partial = True
+                return image
+            image = FirmwareImage()
+
+    data = image.data
+    ranges = []
+    offset = 0
+    lines = text.splitlines()
+    for n in range(len(lines)):
+        line = n + 1
+        s = lines[n].strip()
+        if not s:
+            continue
+        try:
+            rec = hex_record_bytes(s)
+        except ValueError as e:
+            raise ValueError("%s at line %d" % (e, line))
+
+        rectype = rec[3]
+        if rectype == 0:
+            addr = offset + (rec[1] << 8 | rec[2])
+            end = addr + rec[0]
+            if end > len(data):
+                data.extend([image.padding] * (end - len(data)))
+            data[addr:end] = rec[4:-1]
+            if ranges and ranges[-1][1] == addr:
+                ranges[-1][1] = end
             else:
-                pixel_count += 1
-        if total_bytes >= IMAGE_SIZE:
-            break
-        rleimg[total_bytes] = pixel_count
-        total_bytes += 1
-        if total_bytes >= IMAGE_SIZE:
+                ranges.append([addr, end])
+        elif rectype == 1:
             break
+        elif rectype == 2:
+            offset = (rec[4] << 8 | rec[5]) * 16
+        elif rectype == 4:
+            offset = (rec[4] << 8 | rec[5]) << 16
+        elif rectype == 3:
+            image.start_addr = {'CS': rec[4] << 8 | rec[5], 'IP': rec[6] << 8 | rec[7]}
+        elif rectype == 5:
+            image.start_addr = {'EIP': int.from_bytes(rec[4:8], 'big')}
+        else:
+            raise ValueError("Invalid hex record type at line %d" % line)
 
-# Padding for display driver
+    add_hex_ranges(image, ranges)
+    return image
 
-    for r in range(10):
+def hex_record(rectype, addr, payload):
+    rec = bytes((len(payload), addr >> 8, addr & 0xff, rectype)) + payload
+    return ':' + binascii.hexlify(rec + bytes(((-sum(rec)) & 0xff,))).decode().upper() + '\n'
+
+def hex_text(image, byte_count=16):
+    # Produces the same records as IntelHex.write_hex_file()
+    out = []
+
+    if image.start_addr:
+        if sorted(image.start_addr) == ['CS', 'IP']:
+            out.append(hex_record(3, 0, image.start_addr['CS'].to_bytes(2, 'big') + image.start_addr['IP'].to_bytes(2, 'big')))
+        elif sorted(image.start_addr) == ['EIP']:
+            out.append(hex_record(5, 0, image.start_addr['EIP'].to_bytes(4, 'big')))
+        else:
+            raise ValueError("Invalid start address: %r" % image.start_addr)
+
+    need_offset_record = image.ranges and image.ranges[-1][1] - 1 > 0xffff
+    high_ofs = -1
+    for start, end in image.ranges:
+        hexdata = binascii.hexlify(image.data[start:end]).upper().decode()
+        addr = start
+        while addr < end:
+            if need_offset_record and addr >> 16 != high_ofs:
+                high_ofs = addr >> 16
+                out.append(hex_record(4, 0, high_ofs.to_bytes(2, 'big')))
+            low_addr = addr & 0xffff
+            n = min(byte_count, 0x10000 - low_addr, end - addr)
+            head = bytes((n, low_addr >> 8, low_addr & 0xff, 0))
+            cs = (-(sum(head) + sum(image.data[addr:addr + n]))) & 0xff
+            i = (addr - start) * 2
+            out.append(':' + head.hex().upper() + hexdata[i:i + 2 * n] + "{:02X}".format(cs) + '\n')
+            addr += n
+
+    out.append(":00000001FF\n")
+    return ''.join(out)
+
+def write_hex(image, filename, byte_count=16):
+    text = hex_text(image, byte_count)
+    with open(filename, "w") as f:
+        f.write(text)
+
+def read_bin(filename, offset=0):
+    with open(filename, "rb") as f:
+        raw = f.read()
+    image = FirmwareImage()
+    if raw:
+        image.puts(offset, raw)
+    return image
+
+def bin_bytes(image):
+    return bytes(image.data[image.ranges[0][0]:image.ranges[-1][1]]) if image.ranges else b''
+
+def write_bin(image, filename):
+    with open(filename, "wb") as f:
+        f.write(bin_bytes(image))
+
+def read_firmware(filename, regions=None, detect=False):
+    if filename.lower().endswith(".bin"):
+        return read_bin(filename)
+    return read_hex(filename, regions, detect)
+
+def load_firmware(filename, regions=None, detect=False):
+    try:
+        image = read_firmware(filename, regions, detect)
+    except Exception:
+        raise PX41CXError("Error reading hex file: " + filename)
+    if not is_firmware(image):
+        raise PX41CXError("Error: " + filename + "  does not look like PX41CX firmware")
+    return image
+
+def save_firmware(image, filename):
+    if filename.lower().endswith(".bin"):
+        write_bin(image, filename)
+    else:
+        write_hex(image, filename)
+
+
+def is_firmware(image):
+    return not (image[0] != MAGIC1 and image[1] != MAGIC2)
+
+def user_text(raw):
+    text = raw.decode('unicode_escape')
+    return text if text.isprintable() else repr(raw)[2:-1]
+
+def inspect_firmware(filename, image=None, verify=False):
+    # With verify the checksum of each loaded user ROM is checked, which needs the whole
+    # file. The OS ROM locations are not standard pages and are never checked.
+    if image is None:
+        image = read_firmware(filename, None if verify else INSPECT_REGIONS, True)
+        if not is_firmware(image):
+            raise PX41CXError(filename + " does not look like PX41CX firmware")
+
+    info = detect_firmware(image)
+    if image.partial and (verify or info.version is None or info.language is None):
+        # Version or date table outside the usual regions, fall back to the whole file
+        image = read_firmware(filename)
+        info = detect_firmware(image)
+
+    rom_location = get_rom_location(image)
+    roms = []
+    for a in range(ROM_MAP_SIZE):
+        page, bank, bankgroup, modgroup = get_rom(image, a)
+        if page != 255:
+            checksum = None
+            if verify and a >= 6 and image.used(rom_location[a], rom_location[a] + PACKED_SIZE):
+                packed = image.gets(rom_location[a], PACKED_SIZE)
+                checksum = rom_checksum(packed) == rom_word(packed, ROM_WORDS - 1)
+            roms.append(RomEntry(a, page, bank + 1, bankgroup, modgroup, get_name(image, a), checksum))
+        else:
+            roms.append(RomEntry(a, None, None, None, None, get_name(image, a)))
+
+    user = [user_text(image.getsz(addr)) for addr in (USER1, USER2, USER3, USER4)]
+    splash = image.used(SPLASH, SPLASH + 1) and image[SPLASH] in (0, 1)
+    return FirmwareReport(filename, info.version, roms, user, info.language, splash)
+
+def print_report(report):
+    print("PX41CX Firmware:",report.file)
+    if report.version is not None:
+        print(report.version)
+
+    for entry in report.roms:
+        if entry.page is not None:
+            print_rom(entry)
+    for n, text in enumerate(report.user, 1):
+        print("User ",n,": '",text,"'",sep="")
+    print("Date Format: ",LANGUAGE_NAMES.get(report.language, "Unknown"))
+
+def report_json(report):
+    result = report._asdict()
+    result['roms'] = [entry._asdict() for entry in report.roms]
+    return result
+
+
+def check_rom_map(roms):
+    # The same page map checks as a build, for the user ROMs of existing firmware
+    problems = []
+    used = [(e.page, e.bank, e.bankgroup, e.modgroup) for e in roms[6:] if e.page is not None]
+    if len(used) > len(set(used)):
+        problems.append("Duplicate page map")
+    for entry in roms[6:]:
+        if entry.page is not None and (entry.page < 4 or entry.page == 5):
+            problems.append("OS page {:x} in ROM {:02d}".format(entry.page, entry.rom))
+    for entry in roms[6:]:
+        if entry.checksum is False:
+            problems.append("Bad checksum in ROM {:02d}".format(entry.rom))
+    return problems
+
+def audit_firmware(filename, verify=False):
+    try:
+        report = inspect_firmware(filename, verify=verify)
+    except Exception as e:
+        return {'file': filename, 'error': str(e) or type(e).__name__}
+    result = report_json(report)
+    result['problems'] = check_rom_map(report.roms)
+    return result
+
+def audit_csv_row(result):
+    if 'error' in result:
+        return [result['file'], '', '', '', '', result['error']]
+    roms = ";".join("{:02d}:{:x}/{}/{}/{}:{}".format(e['rom'], e['page'], e['bank'], e['bankgroup'], e['modgroup'], e['name'].strip())
+                    for e in result['roms'][6:] if e['page'] is not None)
+    return [result['file'], result['version'] or '', result['language'] or '', int(result['splash']), roms, "; ".join(result['problems'])]
+
+def find_files(paths, pattern):
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for name in sorted(files):
+                    if fnmatch.fnmatch(name.lower(), pattern.lower()):
+                        yield os.path.join(root, name)
+        else:
+            yield path
+
+def map_files(function, files, jobs):
+    # Results of function for each file in completion order, with at most a few files
+    # per process in flight
+    if jobs <= 1:
+        for filename in files:
+            yield function(filename)
+        return
+    from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, as_completed, wait
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        pending = set()
+        for filename in files:
+            pending.add(pool.submit(function, filename))
+            if len(pending) >= jobs * 4:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+        for future in as_completed(pending):
+            yield future.result()
+
+def scan_main(argv):
+    parser = argparse.ArgumentParser(prog='px41cx_utility.py scan', description='Audit PX41CX firmware files.')
+    parser.add_argument('paths',nargs='+',help="Firmware files or directories to search")
+    parser.add_argument('-j','--jobs',type=int,default=os.cpu_count() or 1,help="Number of processes")
+    parser.add_argument('-f','--format',choices=['jsonl','csv'],default='jsonl',help="Output format (default jsonl)")
+    parser.add_argument('-o','--output',type=str,help="Output file (default standard output)")
+    parser.add_argument('--pattern',type=str,default='*.hex',help="File name pattern in directories (default *.hex)")
+    parser.add_argument('--summary',type=str,metavar='FILE',help="Write the summary as JSON to FILE")
+    parser.add_argument('--verify',action='store_true',help="Check the user ROM checksums, reading the whole of each file")
+    args = vars(parser.parse_args(argv))
+
+    out = open(args['output'], "w", newline='') if args['output'] else sys.stdout
+    writer = csv.writer(out) if args['format'] == 'csv' else None
+    if writer:
+        writer.writerow(['file', 'version', 'language', 'splash', 'roms', 'problems'])
+
+    modules = {}
+    versions = {}
+    invalid = []
+    count = 0
+    audit = functools.partial(audit_firmware, verify=args['verify'])
+    for result in map_files(audit, find_files(args['paths'], args['pattern']), args['jobs']):
+        count += 1
+        if writer:
+            writer.writerow(audit_csv_row(result))
+        else:
+            out.write(json.dumps(result) + "\n")
+        out.flush()
+
+        if 'error' in result or result['problems']:
+            invalid.append(result['file'])
+        if 'error' in result:
+            continue
+        versions[result['version']] = versions.get(result['version'], 0) + 1
+        for entry in result['roms'][6:]:
+            if entry['page'] is not None:
+                modules.setdefault(entry['name'].strip(), []).append(result['file'])
+
+    if out is not sys.stdout:
+        out.close()
+
+    print("Scanned",count,"firmware files,",len(invalid),"with problems",file=sys.stderr)
+    for version in sorted(versions, key=str):
+        print("  ",version,": ",versions[version],sep="",file=sys.stderr)
+    for name in sorted(modules, key=lambda n: (-len(modules[n]), n)):
+        print("  {:6} {}".format(name, len(modules[name])),file=sys.stderr)
+
+    if args['summary']:
+        with open(args['summary'], "w") as f:
+            json.dump({'files': count, 'versions': versions, 'modules': modules, 'invalid': invalid}, f, indent=2)
+    return 1 if invalid else 0
+
+def lcd_char(word):
+    # HP-41 display character, bit 6 marks the lower case and special characters
+    c = word & 0x3f
+    ch = chr(c + 0x40) if c < 0x20 else chr(c)
+    return ch.lower() if word & 0x40 else ch
+
+def mcode_name(words, addr):
+    # MCODE function names are stored backwards before the entry point, the last
+    # character has bit 7 set
+    chars = []
+    for a in range(addr - 1, max(addr - 25, 0), -1):
+        chars.append(lcd_char(words[a]))
+        if words[a] & 0x80:
+            return "".join(chars)
+    return None
+
+def focal_name(words, addr):
+    # User code programs start with a global label: Cx yy Fn key name, one byte per word
+    if addr + 4 >= len(words) or words[addr] & 0xf0 != 0xc0 or words[addr + 2] & 0xf0 != 0xf0:
+        return None
+    length = (words[addr + 2] & 0x0f) - 1
+    return "".join(chr(w & 0x7f) for w in words[addr + 4:addr + 4 + length])
+
+def rom_info(filename):
+    # XROM number, function names and bank switching hints of a .ROM file
+    try:
+        stat = os.stat(filename)
+        with open(filename, "rb") as f:
+            rom = f.read()
+    except OSError as e:
+        return {'path': filename, 'error': str(e)}
+    info = {'path': filename, 'mtime': stat.st_mtime, 'size': len(rom), 'sha256': hashlib.sha256(rom).hexdigest()}
+    if len(rom) < ROM_FILE_SIZE:
+        info['error'] = "ROM file too short"
+        return info
+
+    words = [w & 0x3ff for w in struct.unpack_from(">{}H".format(ROM_WORDS), rom)]
+    info['words_sha256'] = hashlib.sha256(struct.pack(">{}H".format(ROM_WORDS), *words)).hexdigest()
+    packed = decode_rom(rom)
+    info['checksum'] = rom_checksum(packed) == words[ROM_WORDS - 1]
+    # The problems a build reports for the file, a longer file is cut to 8 Kb when loaded
+    info['problems'] = (["bad length"] if len(rom) != ROM_FILE_SIZE else []) + check_rom(packed)
+    info['xrom'] = words[0]
+    count = words[1] if words[1] <= FAT_MAX else 0
+    fat = []
+    for n in range(count):
+        hi, lo = words[2 + 2 * n], words[3 + 2 * n]
+        addr = (hi & 0x0f) << 8 | (lo & 0xff)
+        mcode = not hi & 0x200
+        fat.append((mcode_name(words, addr) if mcode else focal_name(words, addr), mcode))
+    info['functions'] = fat
+    info['name'] = (fat[0][0] or "").strip("- ") if fat else None
+    # Page 4 ROMs (take over, library) have no usable function table
+    info['page4'] = words[0] == 0 or not fat
+    info['banks'] = sorted(set(ENROM[w] for w in words if w in ENROM))
+    return info
+
+class RomLibrary:
+    # SQLite index of .ROM files, refreshed incrementally: files with an unchanged mtime
+    # and size are skipped and unchanged contents (by SHA-256) are not decoded again
+
+    def __init__(self, filename):
+        import sqlite3
+        self.db = sqlite3.connect(filename)
+        self.db.executescript(LIBRARY_SCHEMA)
+        columns = [row[1] for row in self.db.execute("PRAGMA table_info(roms)")]
+        for column, kind in (('checksum', 'INTEGER'), ('problems', 'TEXT')):
+            if column not in columns:
+                # Indexes from before checksums and problems were recorded are read again on the next refresh
+                self.db.execute("ALTER TABLE roms ADD COLUMN {} {}".format(column, kind))
+                self.db.execute("UPDATE roms SET mtime = NULL, sha256 = NULL")
+
+    def close(self):
+        self.db.close()
+
+    def refresh(self, paths, pattern="*.rom", jobs=1):
+        db = self.db
+        known = {row[0]: row[1:] for row in db.execute("SELECT path, mtime, size, sha256 FROM roms")}
+        counts = {'added': 0, 'updated': 0, 'unchanged': 0, 'removed': 0}
+
+        stale = []
+        seen = set()
+        for filename in find_files(paths, pattern):
+            filename = os.path.abspath(filename)
+            seen.add(filename)
+            try:
+                stat = os.stat(filename)
+            except OSError:
+                continue
+            row = known.get(filename)
+            if row and row[0] == stat.st_mtime and row[1] == stat.st_size:
+                counts['unchanged'] += 1
+            else:
+                stale.append(filename)
+
+        if jobs > 1 and len(stale) > 1:
+            from concurrent.futures import ProcessPoolExecutor
+            with ProcessPoolExecutor(max_workers=jobs) as pool:
+                infos = list(pool.map(rom_info, stale, chunksize=16))
+        else:
+            infos = [rom_info(filename) for filename in stale]
+
+        for info in infos:
+            path = info['path']
+            counts['updated' if path in known else 'added'] += 1
+            if path in known and known[path][2] == info.get('sha256'):
+                db.execute("UPDATE roms SET mtime = ?, size = ? WHERE path = ?", (info['mtime'], info['size'], path))
+                continue
+            self.store(info)
+
+        for root in paths:
+            root = os.path.abspath(root)
+            prefix = root if not os.path.isdir(root) else os.path.join(root, "")
+            for path in known:
+                if (path == root or path.startswith(prefix)) and path not in seen:
+                    db.execute("DELETE FROM roms WHERE path = ?", (path,))
+                    db.execute("DELETE FROM functions WHERE path = ?", (path,))
+                    counts['removed'] += 1
+        db.commit()
+        return counts
+
+    def store(self, info):
+        db = self.db
+        path = info['path']
+        db.execute("DELETE FROM functions WHERE path = ?", (path,))
+        db.execute("INSERT OR REPLACE INTO roms VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                   (path, info.get('mtime'), info.get('size'), info.get('sha256'), info.get('words_sha256'),
+                    info.get('xrom'), len(info.get('functions', [])), info.get('name'),
+                    int(info.get('page4', False)), ",".join(map(str, info.get('banks', []))), info.get('error'),
+                    info.get('checksum'), ",".join(info.get('problems', []))))
+        db.executemany("INSERT INTO functions VALUES (?, ?, ?, ?)",
+                       [(path, n, name, int(mcode)) for n, (name, mcode) in enumerate(info.get('functions', []))])
+
+    def find(self, term=None, xrom=None, function=None, sha256=None, limit=None):
+        query = "SELECT path, xrom, functions, name, page4, banks, sha256, checksum, problems FROM roms WHERE error IS NULL"
+        params = []
+        if term:
+            query += " AND (name LIKE ? OR path LIKE ? OR path IN (SELECT path FROM functions WHERE name LIKE ?))"
+            params += ["%" + term + "%"] * 3
+        if xrom is not None:
+            query += " AND xrom = ?"
+            params.append(xrom)
+        if function:
+            query += " AND path IN (SELECT path FROM functions WHERE name = ? COLLATE NOCASE)"
+            params.append(function)
+        if sha256:
+            query += " AND sha256 = ?"
+            params.append(sha256.lower())
+        query += " ORDER BY xrom, path"
+        if limit:
+            query += " LIMIT {:d}".format(limit)
+        fields = ['path', 'xrom', 'functions', 'name', 'page4', 'banks', 'sha256', 'checksum', 'problems']
+        results = []
+        for row in self.db.execute(query, params):
+            result = dict(zip(fields, row))
+            result['page4'] = bool(result['page4'])
+            result['checksum'] = None if result['checksum'] is None else bool(result['checksum'])
+            result['banks'] = [int(b) for b in result['banks'].split(",") if b]
+            result['problems'] = [p for p in (result['problems'] or "").split(",") if p]
+            results.append(result)
+        return results
+
+    def function_names(self, path):
+        return [row[0] for row in self.db.execute("SELECT name FROM functions WHERE path = ? ORDER BY number", (path,))]
+
+    def lookup(self, filename, field):
+        # A field of the index entry with the same contents as filename
         try:
-            rleimg[total_bytes] = 0
-            rleimg[total_bytes+1] = 0xfa
-            total_bytes += 2
-        except:
+            with open(filename, "rb") as f:
+                key = hashlib.sha256(f.read()).hexdigest()
+        except OSError:
+            return None
+        row = self.db.execute("SELECT " + field + " FROM roms WHERE sha256 = ? AND error IS NULL LIMIT 1", (key,)).fetchone()
+        return row[0] if row else None
+
+    def is_page4(self, filename):
+        return bool(self.lookup(filename, 'page4'))
+
+    def module_name(self, filename):
+        # The 6 character ROM name for a file from its module name in the index
+        name = self.lookup(filename, 'name')
+        return "{:6.6}".format(name) if name else None
+
+def library_names(library, args):
+    # Module names from the library for the ROM locations of a build
+    args['names'] = {}
+    for num in range(6, ROM_MAP_SIZE):
+        rom = args.get("rom{:02d}".format(num))
+        if rom and (name := library.module_name(rom[0])):
+            args['names'][num] = name
+
+def library_main(argv):
+    parser = argparse.ArgumentParser(prog='px41cx_utility.py library', description='Index and search a library of ROM files.')
+    parser.add_argument('-d','--database',type=str,default="px41cx_library.db",help="Index database (default px41cx_library.db)")
+    commands = parser.add_subparsers(dest='command',required=True)
+    index = commands.add_parser('index',help="Add or refresh ROM files in the index")
+    index.add_argument('paths',nargs='+',help="ROM files or directories to search")
+    index.add_argument('-j','--jobs',type=int,default=os.cpu_count() or 1,help="Number of processes")
+    index.add_argument('--pattern',type=str,default='*.rom',help="File name pattern in directories (default *.rom)")
+    find = commands.add_parser('find',help="Search the index")
+    find.add_argument('term',nargs='?',help="Part of a module name, function name or path")
+    find.add_argument('--xrom',type=int,help="XROM number")
+    find.add_argument('--function',type=str,help="Function name")
+    find.add_argument('--sha256',type=str,help="SHA-256 of the ROM file")
+    find.add_argument('-n','--limit',type=int,help="Maximum number of results")
+    find.add_argument('--json',action='store_true',help="Print the results as JSON")
+    args = vars(parser.parse_args(argv))
+
+    library = RomLibrary(args['database'])
+    try:
+        if args['command'] == 'index':
+            counts = library.refresh(args['paths'], args['pattern'], args['jobs'])
+            print("Indexed: {added} added, {updated} updated, {unchanged} unchanged, {removed} removed".format(**counts))
+            return 0
+
+        results = library.find(args['term'], args['xrom'], args['function'], args['sha256'], args['limit'])
+        if args['json']:
+            for result in results:
+                result['function_names'] = library.function_names(result['path'])
+            print(json.dumps(results, indent=2))
+        else:
+            for r in results:
+                hints = (" page 4" if r['page4'] else "") + (" banks " + ",".join(map(str, r['banks'])) if r['banks'] else "")
+                hints += " bad length" if "bad length" in r['problems'] else ""
+                hints += " bad checksum" if r['checksum'] is False else ""
+                print("XROM {:3} {:3} functions  {:14} {}{}".format(r['xrom'], r['functions'], r['name'] or "", r['path'], hints))
+        return 0 if results else 1
+    finally:
+        library.close()
+
+
+
+def page_options(module, n, pages):
+    # Pages allowed for page n of module given the pages already chosen for pages 0..n-1
+    placement = module.pages[n].placement
+    if isinstance(placement, int):
+        return [placement]
+    if placement not in PLACEMENT_PAGES:
+        raise AllocationError("Invalid placement for {}: {}".format(module.name, placement))
+    previous = [(p.placement, p.group) for p in module.pages[:n]]
+    group = module.pages[n].group
+    if placement == 'upper' and ('lower', group) in previous:
+        return [pages[previous.index(('lower', group))] + 1]
+    if placement == 'lower' and ('upper', group) in previous:
+        return [pages[previous.index(('upper', group))] - 1]
+    if placement == 'ordered' and pages:
+        return [pages[-1] + 1]
+    return PLACEMENT_PAGES[placement]
+
+def page_candidates(module, free_pages):
+    # Every way to place the pages of module on free pages, as (page mask, pages)
+    candidates = []
+    def place(pages, mask):
+        if len(pages) == len(module.pages):
+            candidates.append((mask, tuple(pages)))
+            return
+        for page in page_options(module, len(pages), pages):
+            if page in free_pages and not mask & 1 << page:
+                place(pages + [page], mask | 1 << page)
+    place([], 0)
+    return candidates
+
+def search_pages(candidates, order):
+    # Backtracking over modules with the fewest candidates first, abandoning a branch as
+    # soon as a remaining module has no candidate left on the free pages
+    chosen = {}
+    order = sorted(order, key=lambda m: len(candidates[m]))
+
+    def solve(i, used):
+        if i == len(order):
+            yield dict(chosen)
+            return
+        for mask, pages in candidates[order[i]]:
+            if mask & used:
+                continue
+            if all(any(not c & (used | mask) for c, _ in candidates[m]) for m in order[i + 1:]):
+                chosen[order[i]] = pages
+                yield from solve(i + 1, used | mask)
+
+    return solve(0, 0)
+
+def explain_allocation(modules, candidates, free_pages):
+    # Reduce the modules to a minimal set that cannot be placed together and describe it
+    for m, module in enumerate(modules):
+        if not candidates[m]:
+            wanted = sorted(set(p for page in module.pages
+                                for p in ([page.placement] if isinstance(page.placement, int) else PLACEMENT_PAGES[page.placement])))
+            return "No free page for {}: placement {} needs page {}".format(
+                module.name, ",".join(str(p.placement) for p in module.pages), ",".join("{:x}".format(p) for p in wanted))
+
+    core = list(range(len(modules)))
+    for m in list(core):
+        rest = [x for x in core if x != m]
+        if next(search_pages(candidates, rest), None) is None:
+            core = rest
+    pages = sorted(set(p for m in core for _, c in candidates[m] for p in c))
+    needed = sum(len(modules[m].pages) for m in core)
+    return "Modules {} need {} pages together but can only use page {}".format(
+        ", ".join(modules[m].name for m in core), needed, ",".join("{:x}".format(p) for p in pages))
+
+def allocate(modules, reserved=(), free_slots=range(6, ROM_MAP_SIZE), limit=1):
+    # Assign slots, pages, banks, bank groups and module groups to modules avoiding the
+    # reserved (page, bank, bankgroup, modgroup) map entries, up to limit solutions
+    reserved = [r for r in reserved if r[0] != 255]
+    free_pages = set([4] + ALLOC_PAGES) - set(r[0] for r in reserved)
+    free_slots = list(free_slots)
+
+    roms = sum(len(page.roms) for module in modules for page in module.pages)
+    if roms > len(free_slots):
+        raise AllocationError("{} ROM files but only {} free ROM locations".format(roms, len(free_slots)))
+    for module in modules:
+        for page in module.pages:
+            if isinstance(page.placement, int) and (page.placement < 4 or page.placement == 5 or page.placement > 15):
+                raise AllocationError("Error, OS page {} selected for {}".format(page.placement, module.name))
+            if not 1 <= len(page.roms) <= 4:
+                raise AllocationError("Module {} page needs 1 to 4 banks".format(module.name))
+
+    candidates = [page_candidates(module, free_pages) for module in modules]
+    modgroups = [g for g in range(1, 256) if g not in set(r[3] for r in reserved)]
+    bankgroups = [g for g in range(1, 256) if g not in set(r[2] for r in reserved)]
+
+    solutions = []
+    for chosen in search_pages(candidates, range(len(modules))):
+        slots = iter(free_slots)
+        banked = 0
+        solution = []
+        for m, module in enumerate(modules):
+            bankgroup = 0
+            if any(len(page.roms) > 1 for page in module.pages):
+                bankgroup = bankgroups[banked]
+                banked += 1
+            for page, pages in zip(module.pages, chosen[m]):
+                for bank, rom in enumerate(page.roms, 1):
+                    solution.append(SlotAssignment(next(slots), rom, pages, bank, bankgroup, modgroups[m]))
+        solutions.append(solution)
+        if limit and len(solutions) >= limit:
             break
 
-#    print("Total Bytes:",total_bytes)
-#    print(rleimg)
-    if total_bytes >= IMAGE_SIZE:
-        print("BMP image too complex - not loaded:",filename)
+    if not solutions:
+        raise AllocationError(explain_allocation(modules, candidates, free_pages))
+    return solutions
+
+def parse_module(spec, library=None):
+    # Pages separated by ',', banks of a page by '+' and an optional @placement, for
+    # example PPCL.ROM@lower,PPCU.ROM@upper or ADV1.ROM,ADV2.ROM+ADV3.ROM
+    pages = []
+    for page in spec.split(","):
+        roms, _, placement = page.partition("@")
+        roms = roms.split("+")
+        if not placement:
+            placement = 'any'
+            if library and library.is_page4(roms[0]):
+                placement = 'page4'
+        elif placement not in PLACEMENT_PAGES:
+            try:
+                placement = int(placement, 16)
+            except ValueError:
+                raise AllocationError("Invalid placement: " + placement)
+        pages.append(ModulePage(roms, placement))
+    return Module(rom_name(pages[0].roms[0]).strip(), pages)
+
+def mod_page(image):
+    # Each of the 5 bytes of a group is a lane of 1024 bytes handled as one integer, the
+    # low bytes of the words and the packed high bits are masked and shifted out of them
+    lanes = [int.from_bytes(image[n:PACKED_SIZE:5], 'little') for n in range(5)]
+    low = bytearray(ROM_WORDS)
+    low[0::4] = image[0:PACKED_SIZE:5]
+    low[1::4] = (lanes[1] >> 2 & MOD_LANE[0x3f] | (lanes[2] & MOD_LANE[0x03]) << 6).to_bytes(ROM_WORDS // 4, 'little')
+    low[2::4] = (lanes[2] >> 4 & MOD_LANE[0x0f] | (lanes[3] & MOD_LANE[0x0f]) << 4).to_bytes(ROM_WORDS // 4, 'little')
+    low[3::4] = (lanes[3] >> 6 & MOD_LANE[0x03] | (lanes[4] & MOD_LANE[0x3f]) << 2).to_bytes(ROM_WORDS // 4, 'little')
+    high = lanes[1] & MOD_LANE[0x03] | lanes[2] & MOD_LANE[0x0c] | lanes[3] & MOD_LANE[0x30] | lanes[4] & MOD_LANE[0xc0]
+    return bytes(low) + high.to_bytes(ROM_WORDS // 4, 'little')
+
+def mod_text(field):
+    return field.split(b'\0', 1)[0].decode('latin-1').strip()
+
+def read_mod(filename):
+    # All pages of a MOD file as a Module, banks 2-4 of a page follow its bank 1 page with
+    # the same placement, page group and bank group
+    try:
+        with open(filename, "rb") as f:
+            data = f.read()
+    except OSError:
+        raise PX41CXError("Error opening MOD file: " + filename)
+    if len(data) < MOD_HEADER.size or data[:4] not in MOD_FORMATS:
+        raise PX41CXError("Error not a MOD file: " + filename)
+    header = MOD_HEADER.unpack_from(data)
+    count = header[14]
+    if count == 0 or len(data) != MOD_HEADER.size + count * MOD_PAGE.size:
+        raise PX41CXError("Error MOD file size does not match {} pages: {}".format(count, filename))
+
+    entries = sorted(MOD_PAGE.iter_unpack(data[MOD_HEADER.size:]), key=lambda e: max(e[4], 1))
+    pages = []
+    banked = {}
+    for name, _, placement, pagegroup, bank, bankgroup, _, _, _, image, _ in entries:
+        rom = ModRom(mod_text(name), mod_page(image))
+        if placement <= 0xf:
+            key = placement
+        elif placement in MOD_PLACEMENTS:
+            key = MOD_PLACEMENTS[placement]
+        else:
+            raise PX41CXError("Error invalid page {:02x} for {} in MOD file: {}".format(placement, rom.name, filename))
+        if bank <= 1:
+            pages.append(ModulePage([rom], key, pagegroup))
+            banked.setdefault((key, pagegroup, bankgroup), []).append(pages[-1])
+            continue
+        page = next((p for p in banked.get((key, pagegroup, bankgroup), []) if len(p.roms) == bank - 1), None)
+        if page is None:
+            raise PX41CXError("Error bank {} of {} without the previous banks in MOD file: {}".format(bank, rom.name, filename))
+        page.roms.append(rom)
+    return Module(mod_text(header[1]) or pages[0].roms[0].name or rom_name(filename).strip(), pages)
+
+def load_modules(filename):
+    # JSON list of {"name": ..., "pages": [{"roms": [...], "placement": ...}]}, file names
+    # relative to the module file
+    try:
+        with open(filename, "r") as f:
+            entries = json.load(f)
+    except Exception as e:
+        raise PX41CXError("Error reading module file: {} {}".format(filename, e))
+    base_dir = os.path.dirname(filename)
+    modules = []
+    for entry in entries:
+        pages = []
+        for page in entry['pages']:
+            placement = page.get('placement', 'any')
+            if isinstance(placement, str) and placement not in PLACEMENT_PAGES:
+                placement = int(placement, 16)
+            pages.append(ModulePage([os.path.join(base_dir, rom) for rom in page['roms']], placement))
+        modules.append(Module(entry.get('name') or rom_name(pages[0].roms[0]).strip(), pages))
+    return modules
+
+def allocate_main(argv):
+    parser = argparse.ArgumentParser(prog='px41cx_utility.py allocate', description='Allocate pages, banks and groups for ROM modules.')
+    parser.add_argument('modules',nargs='*',help="Module pages separated by ',', banks by '+', each with an optional @placement "
+                        "(any, page4, lower, upper, even, odd, ordered or a page number)")
+    parser.add_argument('--modules',dest='module_file',type=str,metavar='FILE',help="JSON file of modules")
+    parser.add_argument('--firmware',type=str,help="Keep the ROMs of this firmware, as for a merge")
+    parser.add_argument('--library',type=str,metavar='DB',help="Place page 4 ROMs found in a library index on page 4")
+    parser.add_argument('-n','--limit',type=int,default=1,help="Number of allocations to list, 0 for all (default 1)")
+    parser.add_argument('--json',action='store_true',help="Print the allocations as JSON")
+    args = vars(parser.parse_args(argv))
+
+    library = RomLibrary(args['library']) if args['library'] else None
+    modules = load_modules(args['module_file']) if args['module_file'] else []
+    modules += [parse_module(spec, library) for spec in args['modules']]
+    if library:
+        library.close()
+    if not modules:
+        parser.error("no modules")
+
+    reserved = []
+    free_slots = range(6, ROM_MAP_SIZE)
+    if args['firmware']:
+        image = load_firmware(args['firmware'], INSPECT_REGIONS)
+        reserved = [get_rom(image, n) for n in range(ROM_MAP_SIZE)]
+        free_slots = [n for n in free_slots if reserved[n][0] == 255]
+
+    solutions = allocate(modules, reserved, free_slots, args['limit'])
+    if args['json']:
+        print(json.dumps([[a._asdict() for a in solution] for solution in solutions], indent=2))
+    else:
+        for n, solution in enumerate(solutions):
+            if n:
+                print()
+            for a in solution:
+                print("-{:02d} {} {:x} {} {} {}".format(a.slot, a.rom, a.page, a.bank, a.bankgroup, a.modgroup))
+    return 0
+
+def extract_roms(image, slots=None):
+    # (slot, name, .ROM file contents) for each populated or each selected ROM location.
+    # The OS locations 0-5 are not standard pages (2 overlaps 3) and are not extracted
+    rom_location = get_rom_location(image)
+    roms = []
+    for n in range(6, ROM_MAP_SIZE) if slots is None else slots:
+        if slots is None and get_rom(image, n)[0] == 255:
+            continue
+        try:
+            packed = image.gets(rom_location[n], PACKED_SIZE)
+        except ValueError:
+            continue
+        try:
+            name = get_name(image, n)
+        except ValueError:
+            name = ""
+        roms.append((n, name, encode_rom(packed)))
+    return roms
+
+def extract_firmware(filename, slots=None):
+    try:
+        return filename, extract_roms(load_firmware(filename), slots), None
+    except Exception as e:
+        return filename, [], str(e) or type(e).__name__
+
+def extract_filename(name, n):
+    name = re.sub(r'[^A-Za-z0-9+_-]', '_', name.strip())
+    return (name or "ROM{:02d}".format(n)) + ".ROM"
+
+def parse_slots(text):
+    # Comma separated ROM locations and ranges, for example 6,8-11. Only the user ROM
+    # locations 6-17 can be extracted
+    slots = []
+    for part in text.split(","):
+        first, _, last = part.partition("-")
+        try:
+            slots += range(int(first), int(last or first) + 1)
+        except ValueError:
+            raise PX41CXError("Invalid ROM locations: " + text)
+    if any(n < 6 or n >= ROM_MAP_SIZE for n in slots):
+        raise PX41CXError("Invalid ROM locations: " + text)
+    return slots
+
+def extract_main(argv):
+    parser = argparse.ArgumentParser(prog='px41cx_utility.py extract', description='Extract ROM files from PX41CX firmware.')
+    parser.add_argument('paths',nargs='+',help="Firmware files or directories to search")
+    parser.add_argument('-o','--output',type=str,default=".",help="Directory for the ROM files (default current directory)")
+    parser.add_argument('-s','--slots',type=str,help="ROM locations 6-17 to extract, for example 6,8-11 (default all loaded)")
+    parser.add_argument('-j','--jobs',type=int,default=os.cpu_count() or 1,help="Number of processes")
+    parser.add_argument('--pattern',type=str,default='*.hex',help="File name pattern in directories (default *.hex)")
+    args = vars(parser.parse_args(argv))
+
+    slots = parse_slots(args['slots']) if args['slots'] else None
+    out_dir = args['output']
+    os.makedirs(out_dir, exist_ok=True)
+
+    # ROM files already in the output directory are not written again
+    written = {}
+    for name in sorted(os.listdir(out_dir)):
+        if name.lower().endswith(".rom"):
+            with open(os.path.join(out_dir, name), "rb") as f:
+                written.setdefault(hashlib.sha256(f.read()).hexdigest(), os.path.join(out_dir, name))
+
+    count = errors = roms = new = 0
+    extract = functools.partial(extract_firmware, slots=slots)
+    for filename, extracted, error in map_files(extract, find_files(args['paths'], args['pattern']), args['jobs']):
+        count += 1
+        if error:
+            errors += 1
+            print(filename, "error:", error, file=sys.stderr)
+            continue
+        for n, name, rom in extracted:
+            roms += 1
+            key = hashlib.sha256(rom).hexdigest()
+            path = written.get(key)
+            if path is None:
+                path = os.path.join(out_dir, extract_filename(name, n))
+                if os.path.exists(path):
+                    path = path[:-4] + "-" + key[:8] + ".ROM"
+                with open(path, "wb") as f:
+                    f.write(rom)
+                written[key] = path
+                new += 1
+                print("{} ROM[{:02d}] {} -> {}".format(filename, n, name.strip(), path))
+            else:
+                print("{} ROM[{:02d}] {} -> {} (duplicate)".format(filename, n, name.strip(), path))
+
+    print("Extracted",roms,"ROMs from",count,"firmware files,",new,"written",file=sys.stderr)
+    return 1 if errors else 0
+
+def image_digest(image):
+    # SHA-256 of the used address ranges and their contents
+    h = hashlib.sha256(json.dumps(image.ranges).encode('utf-8'))
+    for start, end in image.ranges:
+        h.update(image.data[start:end])
+    return h.hexdigest()
+
+def block_hashes(image, size):
+    data = bytes(image.data) + bytes([image.padding]) * (size - len(image.data))
+    return [hashlib.blake2b(data[i:i + DIFF_BLOCK], digest_size=8).digest() for i in range(0, size, DIFF_BLOCK)]
+
+def firmware_regions(image):
+    # Named (start, end) regions of the firmware, anything else is reported as Other
+    regions = [("ROM map", ROM_MAP, ROM_MAP + ROM_MAP_SIZE * ROM_MAP_ENTRY),
+               ("ROM names", ROM_NAMES, ROM_NAMES + ROM_MAP_SIZE * NAME_LEN),
+               ("User lines", USER1, USER4 + 0x20)]
+    info = detect_firmware(image)
+    if info.language is not None:
+        regions.append(("Date table", info.date_addr, info.date_addr + len(DATE_TABLES[info.language] if info.fw903plus else DAY_TABLES[info.language])))
+    regions += [("ROM[{:02d}]".format(n), start, start + PACKED_SIZE) for n, start in enumerate(get_rom_location(image))]
+    regions.append(("Splash", SPLASH, SPLASH + IMAGE_SIZE))
+    return regions
+
+def region_pieces(regions, size):
+    # Parts of each (name, start, end) region not in an earlier region, so every address
+    # below size belongs to one region only, and the unclaimed parts as Other
+    claimed = []
+    result = []
+    for name, start, end in regions + [("Other", 0, size)]:
+        pieces = [(start, end)]
+        for a, b in claimed:
+            pieces = [p for s, e in pieces for p in ((s, min(e, a)), (max(s, b), e)) if p[0] < p[1]]
+        claimed += pieces
+        result.append((name, start, end, pieces))
+    return result
+
+def diff_firmware(base, target):
+    # Runs of changed bytes found by comparing block hashes, and the bytes changed in
+    # each region, counting each byte in the first region containing it
+    size = max(len(base.data), len(target.data))
+    size += -size % DIFF_BLOCK
+    base_blocks = block_hashes(base, size)
+    target_blocks = block_hashes(target, size)
+    old = bytes(base.data) + bytes([base.padding]) * (size - len(base.data))
+    new = bytes(target.data) + bytes([target.padding]) * (size - len(target.data))
+
+    runs = []
+    for n, (a, b) in enumerate(zip(base_blocks, target_blocks)):
+        if a == b:
+            continue
+        start, end = n * DIFF_BLOCK, (n + 1) * DIFF_BLOCK
+        while old[start] == new[start]:
+            start += 1
+        while old[end - 1] == new[end - 1]:
+            end -= 1
+        if runs and runs[-1][1] >= start - 8:
+            runs[-1][1] = end
+        else:
+            runs.append([start, end])
+
+    regions = []
+    for name, start, end, pieces in region_pieces(firmware_regions(target), size):
+        changed = 0
+        for piece_start, piece_end in pieces:
+            for run_start, run_end in runs:
+                a, b = max(piece_start, run_start), min(piece_end, run_end)
+                if a < b:
+                    changed += sum(x != y for x, y in zip(old[a:b], new[a:b]))
+        if changed:
+            region = {'region': name, 'start': start, 'end': end, 'changed': changed}
+            if name.startswith("ROM["):
+                n = int(name[4:6])
+                region['base_name'] = get_name(base, n).strip()
+                region['target_name'] = get_name(target, n).strip()
+            regions.append(region)
+    if base.ranges != target.ranges:
+        regions.append({'region': "Used ranges", 'start': None, 'end': None, 'changed': 0})
+
+    runs = [(start, new[start:end]) for start, end in runs]
+    return FirmwareDiff(runs, regions, image_digest(base), image_digest(target), target.ranges, target.start_addr)
+
+def print_diff(diff):
+    if not diff.regions:
+        print("No differences")
+    for r in diff.regions:
+        if r['region'] == "Used ranges":
+            print("Used address ranges changed")
+        elif 'base_name' in r:
+            print("{}: {} bytes changed, {} -> {}".format(r['region'], r['changed'], r['base_name'], r['target_name']))
+        else:
+            print("{}: {} bytes changed".format(r['region'], r['changed']))
+
+def write_patch(diff, filename):
+    # Header line of JSON then the zlib compressed changed runs, each an offset and length
+    # followed by the bytes, and a CRC-32 of everything before it
+    import zlib
+    header = {'base': diff.base_digest, 'target': diff.target_digest, 'ranges': diff.ranges,
+              'start_addr': diff.start_addr, 'regions': diff.regions}
+    payload = b''.join(struct.pack(">II", start, len(data)) + data for start, data in diff.runs)
+    body = PATCH_MAGIC + json.dumps(header).encode('utf-8') + b'\n' + zlib.compress(payload, 9)
+    with open(filename, "wb") as f:
+        f.write(body + struct.pack(">I", zlib.crc32(body)))
+
+def read_patch(filename):
+    import zlib
+    try:
+        with open(filename, "rb") as f:
+            body = f.read()
+    except OSError:
+        raise PX41CXError("Error opening patch file: " + filename)
+    if not body.startswith(PATCH_MAGIC) or len(body) < len(PATCH_MAGIC) + 4:
+        raise PX41CXError("Error not a PX41CX patch file: " + filename)
+    body, crc = body[:-4], struct.unpack(">I", body[-4:])[0]
+    if zlib.crc32(body) != crc:
+        raise PX41CXError("Error patch file is corrupt: " + filename)
+    header, _, payload = body[len(PATCH_MAGIC):].partition(b'\n')
+    header = json.loads(header.decode('utf-8'))
+    payload = zlib.decompress(payload)
+    runs = []
+    offset = 0
+    while offset < len(payload):
+        start, length = struct.unpack_from(">II", payload, offset)
+        runs.append((start, payload[offset + 8:offset + 8 + length]))
+        offset += 8 + length
+    return FirmwareDiff(runs, header['regions'], header['base'], header['target'], header['ranges'], header['start_addr'])
+
+def apply_patch(base, diff):
+    if image_digest(base) != diff.base_digest:
+        raise PX41CXError("Error patch does not apply to this firmware")
+    image = base.copy()
+    for start, data in diff.runs:
+        end = start + len(data)
+        if end > len(image.data):
+            image.data.extend([image.padding] * (end - len(image.data)))
+        image.data[start:end] = data
+    image.ranges = [list(r) for r in diff.ranges]
+    image.start_addr = diff.start_addr
+    image.writes += 1
+    if image_digest(image) != diff.target_digest:
+        raise PX41CXError("Error patched firmware does not match the target")
+    return image
+
+def diff_main(argv):
+    parser = argparse.ArgumentParser(prog='px41cx_utility.py diff', description='Compare PX41CX firmware and write a patch.')
+    parser.add_argument('base')
+    parser.add_argument('target')
+    parser.add_argument('-o','--output',type=str,metavar='PATCH',help="Write a patch from base to target")
+    parser.add_argument('--json',action='store_true',help="Print the changed regions as JSON")
+    args = vars(parser.parse_args(argv))
+
+    diff = diff_firmware(load_firmware(args['base']), load_firmware(args['target']))
+    if args['json']:
+        print(json.dumps(diff.regions, indent=2))
+    else:
+        print_diff(diff)
+    if args['output']:
+        write_patch(diff, args['output'])
+    return 0
+
+def patch_main(argv):
+    parser = argparse.ArgumentParser(prog='px41cx_utility.py patch', description='Apply a patch to PX41CX firmware.')
+    parser.add_argument('base')
+    parser.add_argument('patch')
+    parser.add_argument('outfile')
+    args = vars(parser.parse_args(argv))
+
+    diff = read_patch(args['patch'])
+    save_firmware(apply_patch(load_firmware(args['base']), diff), args['outfile'])
+    print_diff(diff)
+    return 0
+
+class Profiler:
+    # Wall time and tracemalloc peak memory (above the memory in use at the start) of
+    # each build phase, each record is also passed to callback as the phase finishes.
+    # Memory needs tracemalloc.reset_peak() (Python 3.9), tracing already started by
+    # the caller is left running.
+
+    def __init__(self, callback=None, memory=True):
+        self.records = []
+        self.callback = callback
+        self.variant = None
+        self.tracemalloc = None
+        self.started = False
+        if memory:
+            import tracemalloc
+            if hasattr(tracemalloc, 'reset_peak'):
+                self.tracemalloc = tracemalloc
+                if not tracemalloc.is_tracing():
+                    tracemalloc.start()
+                    self.started = True
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        if self.tracemalloc:
+            self.tracemalloc.reset_peak()
+            before = self.tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            peak = self.tracemalloc.get_traced_memory()[1] - before if self.tracemalloc else None
+            self.add(ProfileRecord(self.variant, name, seconds, peak))
+
+    def add(self, record):
+        self.records.append(record)
+        if self.callback:
+            self.callback(record)
+
+    def stop(self):
+        if self.started:
+            self.tracemalloc.stop()
+            self.started = False
+
+    def print_table(self):
+        print("{:24} {:>10} {:>10}".format("Phase", "Time (ms)", "Peak (KB)"))
+        for record in self.records:
+            name = record.phase if record.variant is None else record.variant + " " + record.phase
+            peak = "" if record.peak is None else "{:.1f}".format(record.peak / 1024)
+            print("{:24} {:>10.2f} {:>10}".format(name, record.seconds * 1000, peak))
+        print("{:24} {:>10.2f}".format("Total", sum(r.seconds for r in self.records) * 1000))
+
+    def json(self):
+        return [record._asdict() for record in self.records]
+
+def print_profile(profile, fmt='table'):
+    profile.stop()
+    if fmt == 'json':
+        print(json.dumps({'profile': profile.json()}, indent=2))
+    else:
+        profile.print_table()
+
+def profile_phase(profile, name):
+    return profile.phase(name) if profile else contextlib.nullcontext()
+
+def set_slot(image, num, romfile, page, bank, bankgroup, modgroup, cache=None, name=None, checksum='warn'):
+    # Load romfile into user ROM location num (6-17) and map it, bank is counted from 1,
+    # the ROM name defaults to the start of the file name. Returns the problems found by
+    # check_rom() and a file that is not 8 Kb, with checksum 'fix' a bad checksum is
+    # repaired and a longer file cut to 8 Kb and with 'error' any problem raises PX41CXError.
+    check_slot(num, page, bank, bankgroup, modgroup)
+    ba = bytearray(PACKED_SIZE)
+    length = read_rom(ba, romfile, cache)
+    return put_slot(image, num, ba, name or rom_name(romfile), page, bank, bankgroup, modgroup, checksum, romfile, length)
+
+def check_slot(num, page, bank, bankgroup, modgroup):
+    # Raises PX41CXError before anything is written for a map entry the firmware cannot use
+    if num < 6 or num >= ROM_MAP_SIZE:
+        raise PX41CXError("Invalid ROM location: {}".format(num))
+    if page < 4 or page == 5:
+        raise PX41CXError("Error, OS page {} selected".format(page))
+    if page > 15:
+        raise PX41CXError("Invalid page: {:x}".format(page))
+    if not 1 <= bank <= 4:
+        raise PX41CXError("Invalid bank: {}".format(bank))
+    if not (0 <= bankgroup <= 255 and 0 <= modgroup <= 255):
+        raise PX41CXError("Invalid bank group or module group: {} {}".format(bankgroup, modgroup))
+
+def put_slot(image, num, ba, name, page, bank, bankgroup, modgroup, checksum='warn', source=None, length=ROM_FILE_SIZE):
+    # Store the packed page ba, read from a file of length bytes, in ROM location num as
+    # for set_slot()
+    check_slot(num, page, bank, bankgroup, modgroup)
+    problems = []
+    if checksum != 'ignore':
+        problems = (["bad length"] if length != ROM_FILE_SIZE else []) + check_rom(ba)
+    if problems and checksum == 'error':
+        raise PX41CXError("Error {} in ROM file: {}".format(" and ".join(problems), source or name))
+    if checksum == 'fix':
+        if "bad length" in problems:
+            problems[problems.index("bad length")] = "fixed length"
+        if "bad checksum" in problems:
+            fix_rom_checksum(ba)
+            problems[problems.index("bad checksum")] = "fixed checksum"
+    image.puts(get_rom_location(image)[num], ba)
+    image.putsz(ROM_NAMES + num * NAME_LEN, "{:6.6}".format(name))
+    set_rom(image, num, page, bank - 1, bankgroup, modgroup)
+    return problems
+
+def set_modules(image, modfiles, reserved=(), free_slots=range(6, ROM_MAP_SIZE), checksum='warn'):
+    # Load every page of the MOD files into consecutive free ROM locations, each module with
+    # its own module group, avoiding the reserved map entries. Returns the slot assignments
+    # with the problems found for each page.
+    modules = [read_mod(modfile) for modfile in modfiles]
+    sources = {id(rom): modfile for modfile, module in zip(modfiles, modules) for page in module.pages for rom in page.roms}
+    loaded = []
+    for a in allocate(modules, reserved, free_slots)[0]:
+        source = "{} {}".format(sources[id(a.rom)], a.rom.name)
+        loaded.append((a, put_slot(image, a.slot, bytearray(a.rom.packed), a.rom.name, a.page, a.bank,
+                                   a.bankgroup, a.modgroup, checksum, source)))
+    return loaded
+
+def clear_slot(image, num):
+    set_rom(image, num, 255, 255, 255, 255)
+    image.putsz(ROM_NAMES + num * NAME_LEN, "EMPTY ")
+
+def set_user_text(image, line, text):
+    # Info menu text lines 1-4
+    if line < 1 or line > 4:
+        raise PX41CXError("Invalid user text line: {}".format(line))
+    image.putsz((USER1, USER2, USER3, USER4)[line - 1], "{:31.31}".format(text))
+
+def set_language(image, lang):
+    # Returns False if the date strings are not found
+    if lang not in LANGUAGES:
+        raise PX41CXError("Invalid language: {}".format(lang))
+    info = detect_firmware(image)
+    if info.language is None:
+        return False
+    if info.fw903plus:
+        image.puts(info.date_addr, DATE_TABLES[lang])
+    elif image.find(MONTH_TABLES[lang]) != -1:
+        image.puts(info.date_addr, DAY_TABLES[lang])
     else:
+        return False
+    return True
+
+def set_splash(image, filename, fit=False):
+    # Returns the longest run length merged by fit (0 if none)
+    runs = read_splash(filename)
+    merged = 0
+    if fit and splash_size(runs) >= IMAGE_SIZE:
+        runs, merged = fit_splash(runs)
+
+    rleimg, total_bytes = encode_splash(runs)
+    if total_bytes >= IMAGE_SIZE:
+        raise SplashError("BMP image too complex - not loaded: " + filename)
+    image.puts(SPLASH, rleimg)
+    return merged
+
+def build_firmware(ih, args, cache=None, profile=None):
+    rom_map = [[0 for _ in range(ROM_MAP_ENTRY)] for _ in range(ROM_MAP_SIZE)]
+
+    changed = False
+
+    for key in args:
+        if args[key] and key.startswith("rom"):
+            num = int(key[-2:])
+            try:
+                rom_map[num] = [int(args[key][1],16), int(args[key][2]), int(args[key][3]), int(args[key][4])]
+            except ValueError:
+                raise PX41CXError("Invalid argument: {} {}".format(-num, " ".join(args[key])))
+            with profile_phase(profile, key):
+                problems = set_slot(ih, num, args[key][0], *rom_map[num], cache, args.get('names', {}).get(num), args.get('checksum', 'warn'))
+            for problem in problems:
+                print("ROM file ",args[key][0],": ",problem,sep="")
+            rom_map[num][1] -= 1
+            changed = True
+
+    if args.get('mods'):
+        # MOD pages go in the locations not given on the command line, or for a merge
+        # not holding a ROM already, keeping clear of the OS bank groups
+        reserved = [get_rom(ih, n) for n in range(6)] + [entry for entry in rom_map if any(entry)]
+        free_slots = [n for n in range(6, ROM_MAP_SIZE) if not any(rom_map[n])]
+        if args['merge']:
+            reserved += [get_rom(ih, n) for n in free_slots]
+            free_slots = [n for n in free_slots if get_rom(ih, n)[0] == 255]
+        with profile_phase(profile, "mods"):
+            loaded = set_modules(ih, args['mods'], reserved, free_slots, args.get('checksum', 'warn'))
+        for a, problems in loaded:
+            print_rom(RomEntry(a.slot, a.page, a.bank, a.bankgroup, a.modgroup, a.rom.name))
+            for problem in problems:
+                print("MOD file ",a.rom.name,": ",problem,sep="")
+            rom_map[a.slot] = [a.page, a.bank - 1, a.bankgroup, a.modgroup]
         changed = True
-        newrom.frombytes(rleimg, offset=SPLASH)
-        ih.merge(newrom, overlap="replace")
-    
-####
-if changed:
-    ih.write_hex_file(args['outfile'], byte_count=16)
-else:
-    print("No change - no output file created")
 
+    rom_nonzero = [i for i in rom_map if any(i)]
+    unique_map = [list(x) for x in set(tuple(x) for x in rom_nonzero)]
+
+    if changed and len(rom_nonzero) > len(unique_map):
+        raise PX41CXError("Duplicate page map - no file output")
+    else:
+        if changed:
+            if not args['merge']:
+                for n in range(6, ROM_MAP_SIZE):
+                    if not any(rom_map[n]):
+                        clear_slot(ih, n)
+        else:
+            print("No ROM changes")
+
+    with profile_phase(profile, "user"):
+        for line in range(1, 5):
+            if args['user' + str(line)] != None:
+                set_user_text(ih, line, args['user' + str(line)])
+                changed = True
+
+    if (languages := [lang for lang in LANGUAGES if args[lang]]):
+        with profile_phase(profile, "language"):
+            lang = languages[0]
+            if detect_firmware(ih).language is not None:
+                print("Set language:",LANGUAGE_NAMES[lang])
+            if set_language(ih, lang):
+                changed = True
+            if not changed:
+                print("Error: Date strings not found")
+
+    if args['bmpfile']:
+        with profile_phase(profile, "splash"):
+            try:
+                merged = set_splash(ih, args['bmpfile'], args['fit'])
+                if merged:
+                    print("BMP image simplified, runs up to",merged,"pixels merged:",args['bmpfile'])
+                changed = True
+            except SplashError as e:
+                print(e)
+
+    return changed
+
+def load_manifest(filename):
+    try:
+        with open(filename, "rb") as f:
+            if filename.lower().endswith(".toml"):
+                import tomllib
+                manifest = tomllib.load(f)
+            else:
+                manifest = json.load(f)
+    except ImportError:
+        raise PX41CXError("Error TOML manifests require Python 3.11 or later: " + filename)
+    except Exception as e:
+        raise PX41CXError("Error reading manifest file: {} {}".format(filename, e))
+
+    if isinstance(manifest, dict):
+        manifest = manifest.get('variants', [])
+
+    base_dir = os.path.dirname(filename)
+    return [manifest_args(entry, base_dir) for entry in manifest]
+
+def manifest_args(entry, base_dir=""):
+    # Translate a manifest entry into the same argument dictionary as the command line
+    args = {'outfile': entry.get('outfile'), 'merge': bool(entry.get('merge', False))}
+    if 'checksum' in entry:
+        args['checksum'] = entry['checksum']
+    if not args['outfile']:
+        raise PX41CXError("Error manifest entry without outfile: {}".format(entry))
+    args['outfile'] = os.path.join(base_dir, args['outfile'])
+
+    roms = entry.get('roms', {})
+    for num in range(6, ROM_MAP_SIZE):
+        rom = roms.get("{:02d}".format(num), roms.get(str(num)))
+        if rom is not None:
+            if len(rom) != 5:
+                raise PX41CXError("Invalid manifest ROM entry: {} {}".format(num, rom))
+            rom = [os.path.join(base_dir, str(rom[0]))] + [str(x) for x in rom[1:]]
+        args["rom{:02d}".format(num)] = rom
+
+    user = entry.get('user', [])
+    for n in range(4):
+        args['user' + str(n + 1)] = entry.get('user' + str(n + 1), user[n] if n < len(user) else None)
+
+    args['mods'] = [os.path.join(base_dir, mod) for mod in entry.get('mods', [])]
+    args['bmpfile'] = os.path.join(base_dir, entry['bmpfile']) if entry.get('bmpfile') else None
+    args['fit'] = bool(entry.get('fit', False))
+
+    language = entry.get('language')
+    if language is not None and language not in LANGUAGES:
+        raise PX41CXError("Invalid manifest language: {}".format(language))
+    for lang in LANGUAGES:
+        args[lang] = lang == language
+    return args
+
+def build_variant(base, args, cache=None, profile=None):
+    print("Building:",args['outfile'])
+    if profile:
+        profile.variant = args['outfile']
+    with profile_phase(profile, "copy"):
+        ih = base.copy()
+    if build_firmware(ih, args, cache, profile):
+        with profile_phase(profile, "write"):
+            save_firmware(ih, args['outfile'])
+    else:
+        print("No change - no output file created")
+    return args['outfile']
+
+def init_batch_worker(base, cache, profile_memory=None):
+    global batch_base, batch_cache, batch_profile_memory
+    batch_base = base
+    batch_cache = cache
+    batch_profile_memory = profile_memory
+
+def build_batch_worker(args):
+    # Profile records are collected in the worker and returned with the cache statistics
+    profile = Profiler(memory=batch_profile_memory) if batch_profile_memory is not None else None
+    outfile = build_variant(batch_base, args, batch_cache, profile)
+    records = []
+    if profile:
+        profile.stop()
+        records = profile.records
+    if batch_cache is None:
+        return outfile, None, records
+    stats = batch_cache.stats()
+    batch_cache.reset_stats()
+    return outfile, stats, records
+
+def manifest_variants(manifest, checksum='warn', library=None):
+    variants = load_manifest(manifest)
+    for args in variants:
+        args.setdefault('checksum', checksum)
+    if library:
+        for args in variants:
+            library_names(library, args)
+    return variants
+
+def build_batch(base, manifest, jobs=1, cache=None, profile=None, library=None, checksum='warn'):
+    variants = manifest_variants(manifest, checksum, library)
+
+    if jobs > 1 and len(variants) > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        profile_memory = None if profile is None else profile.tracemalloc is not None
+        with ProcessPoolExecutor(max_workers=jobs, initializer=init_batch_worker, initargs=(base, cache, profile_memory)) as pool:
+            for outfile, stats, records in pool.map(build_batch_worker, variants):
+                if stats is not None:
+                    cache.add_stats(stats)
+                for record in records:
+                    profile.add(record)
+    else:
+        for args in variants:
+            build_variant(base, args, cache, profile)
+
+def build_inputs(args):
+    # Input files of a build and the stages of build_firmware() that read them
+    inputs = {}
+    for key in args:
+        if args[key] and key.startswith("rom"):
+            inputs.setdefault(args[key][0], set()).add(key)
+    for mod in args.get('mods') or []:
+        inputs.setdefault(mod, set()).add('mods')
+    if args.get('bmpfile'):
+        inputs.setdefault(args['bmpfile'], set()).add('splash')
+    return inputs
+
+def changed_stages(old, new):
+    # Stages to apply again when the build arguments change from old to new, None when
+    # the firmware has to be built again from the infile
+    stages = set()
+    for key in set(old) | set(new):
+        if old.get(key) == new.get(key):
+            continue
+        if key.startswith("user") and new.get(key) is not None:
+            stages.add('user')
+        elif key in LANGUAGES and any(new.get(lang) for lang in LANGUAGES):
+            stages.add('language')
+        elif key in ('bmpfile', 'fit') and new.get('bmpfile'):
+            stages.add('splash')
+        elif key.startswith("rom") and old.get(key) and new.get(key) and old[key][1:] == new[key][1:]:
+            stages.add(key)
+        else:
+            return None
+    return stages
+
+def build_stage(ih, args, stage, cache=None):
+    # Apply one stage of build_firmware() again to the firmware it built, each stage
+    # rewrites all of its part of the firmware. A splash screen that does not fit raises
+    # SplashError as the firmware then needs the splash screen of the infile.
+    if stage.startswith("rom"):
+        num = int(stage[-2:])
+        romfile, page, bank, bankgroup, modgroup = args[stage]
+        problems = set_slot(ih, num, romfile, int(page, 16), int(bank), int(bankgroup), int(modgroup), cache,
+                            args.get('names', {}).get(num), args.get('checksum', 'warn'))
+        for problem in problems:
+            print("ROM file ",romfile,": ",problem,sep="")
+    elif stage == 'user':
+        for line in range(1, 5):
+            if args['user' + str(line)] is not None:
+                set_user_text(ih, line, args['user' + str(line)])
+    elif stage == 'language':
+        if not set_language(ih, [lang for lang in LANGUAGES if args[lang]][0]):
+            print("Error: Date strings not found")
+    elif stage == 'splash':
+        set_splash(ih, args['bmpfile'], args['fit'])
+    else:
+        raise ValueError("Stage cannot be applied again: " + stage)
+
+def file_stamp(filename):
+    try:
+        st = os.stat(filename)
+        return st.st_mtime_ns, st.st_size
+    except OSError:
+        return None
+
+def watch_firmware(infile, base, variants, manifest=None, cache=None, library=None, checksum='warn', interval=0.25):
+    # Build the variants then poll the modification times of the infile, manifest and
+    # input files. A changed ROM file is loaded into its location again, a changed BMP
+    # re-encodes the splash screen and a manifest change applies only the stages that
+    # differ, anything else builds the variant again from the parsed infile.
+    builds = {}
+
+    def build(args):
+        ih = base.copy()
+        if build_firmware(ih, args, cache):
+            save_firmware(ih, args['outfile'])
+        builds[args['outfile']] = (args, ih)
+        return "all"
+
+    def rebuild(args, ih, stages):
+        try:
+            for stage in sorted(stages):
+                build_stage(ih, args, stage, cache)
+        except SplashError:
+            return build(args)
+        builds[args['outfile']] = (args, ih)
+        save_firmware(ih, args['outfile'])
+        return ",".join(sorted(stages))
+
+    def watched():
+        files = [infile] + ([manifest] if manifest else [])
+        for args, _ in builds.values():
+            files += build_inputs(args)
+        return {f: file_stamp(f) for f in files}
+
+    for args in variants:
+        build(args)
+    stamps = watched()
+    print("Watching",len(stamps),"files, Ctrl-C to stop")
+    sys.stdout.flush()
+
+    try:
+        while True:
+            time.sleep(interval)
+            changed = set(f for f, stamp in stamps.items() if file_stamp(f) != stamp)
+            if not changed:
+                continue
+            start = time.perf_counter()
+            done = []
+            try:
+                if infile in changed:
+                    base = load_firmware(infile)
+                    for args, _ in list(builds.values()):
+                        done.append((args['outfile'], build(args)))
+                elif manifest in changed:
+                    variants = manifest_variants(manifest, checksum, library)
+                    for outfile in set(builds) - set(args['outfile'] for args in variants):
+                        del builds[outfile]
+                    for args in variants:
+                        old, ih = builds.get(args['outfile'], ({}, None))
+                        stages = changed_stages(old, args) if ih is not None else None
+                        stages = stages if stages is not None and not changed & set(build_inputs(args)) else None
+                        if stages is None:
+                            done.append((args['outfile'], build(args)))
+                        elif stages:
+                            done.append((args['outfile'], rebuild(args, ih, stages)))
+                else:
+                    for outfile, (args, ih) in list(builds.items()):
+                        inputs = build_inputs(args)
+                        stages = set(stage for f in changed & set(inputs) for stage in inputs[f])
+                        if 'mods' in stages:
+                            done.append((outfile, build(args)))
+                        elif stages:
+                            done.append((outfile, rebuild(args, ih, stages)))
+            except PX41CXError as e:
+                print(e)
+            stamps = watched()
+            for outfile, stages in done:
+                print("Rebuilt",outfile,"(" + stages + ") in","{:.1f}".format(1000 * (time.perf_counter() - start)),"ms")
+            sys.stdout.flush()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+def build_main(argv):
+    parser = argparse.ArgumentParser(description='Update ROMs and options in PX41CX Firmware.')
+    parser.add_argument('infile')
+    parser.add_argument('outfile',nargs='?')
+    parser.add_argument('-m','--merge',action='store_true',help="Merge with existing firmware ROMs")
+    parser.add_argument('-06',dest='rom06',nargs=5,type=str,metavar=('romfile','page','bank','bankgroup','modgroup'))
+    parser.add_argument('-07',dest='rom07',nargs=5,type=str,metavar=('romfile','page','bank','bankgroup','modgroup'))
+    parser.add_argument('-08',dest='rom08',nargs=5,type=str,metavar=('romfile','page','bank','bankgroup','modgroup'))
+    parser.add_argument('-09',dest='rom09',nargs=5,type=str,metavar=('romfile','page','bank','bankgroup','modgroup'))
+    parser.add_argument('-10',dest='rom10',nargs=5,type=str,metavar=('romfile','page','bank','bankgroup','modgroup'))
+    parser.add_argument('-11',dest='rom11',nargs=5,type=str,metavar=('romfile','page','bank','bankgroup','modgroup'))
+    parser.add_argument('-12',dest='rom12',nargs=5,type=str,metavar=('romfile','page','bank','bankgroup','modgroup'))
+    parser.add_argument('-13',dest='rom13',nargs=5,type=str,metavar=('romfile','page','bank','bankgroup','modgroup'))
+    parser.add_argument('-14',dest='rom14',nargs=5,type=str,metavar=('romfile','page','bank','bankgroup','modgroup'))
+    parser.add_argument('-15',dest='rom15',nargs=5,type=str,metavar=('romfile','page','bank','bankgroup','modgroup'))
+    parser.add_argument('-16',dest='rom16',nargs=5,type=str,metavar=('romfile','page','bank','bankgroup','modgroup'))
+    parser.add_argument('-17',dest='rom17',nargs=5,type=str,metavar=('romfile','page','bank','bankgroup','modgroup'))
+    parser.add_argument('--mod',dest='mods',action='append',metavar='MODFILE',help="Load all pages of a MOD1/MOD2 module file into free ROM locations")
+    parser.add_argument('-u1',dest='user1',type=str,help="Info menu configurable text line 1")
+    parser.add_argument('-u2',dest='user2',type=str,help="Info menu configurable text line 2")
+    parser.add_argument('-u3',dest='user3',type=str,help="Info menu configurable text line 3")
+    parser.add_argument('-u4',dest='user4',type=str,help="Info menu configurable text line 4")
+    parser.add_argument('-b',dest='bmpfile',type=str,help="BMP file for splash screen" )
+    parser.add_argument('--fit',action='store_true',help="Simplify a BMP that is too complex for the splash screen")
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument("-eng", action="store_true",help="Set date strings to English")
+    group.add_argument("-fre", action="store_true",help="Set date strings to French")
+    group.add_argument("-spa", action="store_true",help="Set date strings to Spanish")
+    group.add_argument("-ger", action="store_true",help="Set date strings to German")
+    group.add_argument("-ita", action="store_true",help="Set date strings to Italian")
+    group.add_argument("-por", action="store_true",help="Set date strings to Portuguese")
+    parser.add_argument('--manifest',type=str,help="JSON or TOML manifest of firmware variants to build from infile")
+    parser.add_argument('-j','--jobs',type=int,default=1,help="Number of processes for manifest builds")
+    parser.add_argument('--cache',type=str,metavar='DIR',help="Directory to cache decoded ROM files")
+    parser.add_argument('--cache-size',type=int,default=64,metavar='MB',help="Maximum size of the ROM cache (default 64)")
+    parser.add_argument('--stats',action='store_true',help="Print ROM cache statistics")
+    parser.add_argument('--library',type=str,metavar='DB',help="Name ROMs from their module names in a library index")
+    parser.add_argument('--checksum',choices=['warn','fix','error','ignore'],default='warn',help="Bad ROM checksums are reported (default), fixed, an error or ignored")
+    parser.add_argument('--json',action='store_true',help="Print the firmware information as JSON")
+    parser.add_argument('--profile',nargs='?',const='table',choices=['table','json'],help="Print the time and peak memory of each phase")
+    parser.add_argument('--no-memory',action='store_true',help="Profile time only, tracing memory slows the pure Python phases")
+    parser.add_argument('--verify',action='store_true',help="Check the checksums of the user ROMs when viewing firmware")
+    parser.add_argument('--watch',action='store_true',help="Keep rebuilding the outfile (or manifest variants) as the input files change")
+    parser.add_argument('--interval',type=float,default=0.25,metavar='SECONDS',help="Time between checks for changed files with --watch (default 0.25)")
+
+    args = vars(parser.parse_args(argv))
+    arg_count = len(args)
+    inspect = (arg_count - list(args.values()).count(None) == 1) or (not args['outfile'] and not args['bmpfile'] and not args['manifest'])
+
+    profile = Profiler(memory=not args['no_memory']) if args['profile'] else None
+
+    with profile_phase(profile, "load"):
+        ih = load_firmware(args['infile'], INSPECT_REGIONS if inspect and not args['verify'] else None, inspect)
+
+    if inspect:
+        with profile_phase(profile, "inspect"):
+            report = inspect_firmware(args['infile'], ih, args['verify'])
+        if args['json']:
+            result = report_json(report)
+            if args['profile'] == 'json':
+                result['profile'] = profile.json()
+            print(json.dumps(result, indent=2))
+        else:
+            print_report(report)
+        if profile and not (args['json'] and args['profile'] == 'json'):
+            print_profile(profile, args['profile'])
+        return 0
+
+    rom_cache = None
+    if args['cache']:
+        rom_cache = RomCache(args['cache'], args['cache_size'] * 1024 * 1024)
+
+    library = None
+    if args['library']:
+        library = RomLibrary(args['library'])
+        library_names(library, args)
+
+    if args['watch']:
+        variants = manifest_variants(args['manifest'], args['checksum'], library) if args['manifest'] else [args]
+        watch_firmware(args['infile'], ih, variants, args['manifest'], rom_cache or MemoryCache(), library,
+                       args['checksum'], args['interval'])
+    elif args['manifest']:
+        build_batch(ih, args['manifest'], args['jobs'], rom_cache, profile, library, args['checksum'])
+    elif build_firmware(ih, args, rom_cache, profile):
+        with profile_phase(profile, "write"):
+            save_firmware(ih, args['outfile'])
+    else:
+        print("No change - no output file created")
+
+    if args['stats'] and rom_cache is not None:
+        rom_cache.print_stats()
+    if library:
+        library.close()
+    if profile:
+        print_profile(profile, args['profile'])
+    return 0
+
+def init_serve_worker(root, base_size, rom_size):
+    global serve_root, serve_bases, serve_roms
+    serve_root = root
+    serve_bases = MemoryCache(base_size, lambda image: len(image.data), "Base firmware cache")
+    serve_roms = MemoryCache(rom_size, label="ROM cache")
+
+def serve_path(filename):
+    # Request file names must resolve to files under the server root
+    root = os.path.realpath(serve_root)
+    path = os.path.realpath(os.path.join(root, filename))
+    if os.path.commonpath([root, path]) != root:
+        raise PX41CXError("Error file outside the server root: " + filename)
+    return path
+
+def serve_base(filename):
+    # Parsed base firmware, parsed again if the file has changed
+    try:
+        st = os.stat(filename)
+    except OSError:
+        raise PX41CXError("Error opening firmware file: " + filename)
+    return serve_bases.get((filename, st.st_mtime_ns, st.st_size), lambda: load_firmware(filename))
+
+def serve_build(request):
+    # Build a firmware for a request in a worker. Returns the HTTP status, content type,
+    # body, build messages and the cache statistics since the previous build.
+    import io
+    log = io.StringIO()
+    try:
+        if not isinstance(request, dict) or not request.get('base'):
+            raise PX41CXError("Error request without base firmware")
+        if request.get('format', 'hex') not in ('hex', 'bin'):
+            raise PX41CXError("Invalid format: {}".format(request['format']))
+        args = manifest_args(dict(request, outfile=request['base']), "")
+        for key in args:
+            if args[key] and key.startswith("rom"):
+                args[key] = [serve_path(args[key][0])] + args[key][1:]
+        args['mods'] = [serve_path(mod) for mod in args['mods']]
+        if args['bmpfile']:
+            args['bmpfile'] = serve_path(args['bmpfile'])
+        base = serve_path(str(request['base']))
+        with contextlib.redirect_stdout(log):
+            base = serve_base(base)
+            ih = base.copy()
+            build_firmware(ih, args, serve_roms)
+        if request.get('format') == 'bin':
+            result = (200, 'application/octet-stream', bin_bytes(ih))
+        else:
+            result = (200, 'text/plain', hex_text(ih).encode('ascii'))
+    except PX41CXError as e:
+        result = (400, 'application/json', json.dumps({'error': str(e)}).encode('utf-8'))
+    except (AttributeError, KeyError, TypeError, ValueError) as e:
+        result = (400, 'application/json', json.dumps({'error': "Invalid request: {}".format(e)}).encode('utf-8'))
+    stats = (serve_bases.stats(), serve_roms.stats())
+    serve_bases.reset_stats()
+    serve_roms.reset_stats()
+    return result + (log.getvalue().splitlines(),) + stats
+
+class BuildServer:
+    # HTTP/1.1 build service. POST /build takes a JSON object like a manifest variant with
+    # the base firmware file ("base") and "format" (hex or bin) instead of the outfile and
+    # streams back the firmware, GET /metrics returns the request latency and cache
+    # statistics. Builds run in a worker process pool, or a worker thread for 1 job.
+
+    def __init__(self, root=".", jobs=1, base_size=32 * 1024 * 1024, rom_size=16 * 1024 * 1024):
+        from collections import deque
+        if jobs > 1:
+            from concurrent.futures import ProcessPoolExecutor as Executor
+        else:
+            from concurrent.futures import ThreadPoolExecutor as Executor
+        self.pool = Executor(max_workers=max(jobs, 1), initializer=init_serve_worker, initargs=(root, base_size, rom_size))
+        self.latency = deque(maxlen=SERVE_LATENCIES)
+        self.requests = 0
+        self.builds = 0
+        self.errors = 0
+        self.base_cache = MemoryCache(0, label="Base firmware cache")
+        self.rom_cache = MemoryCache(0, label="ROM cache")
+
+    async def handle(self, reader, writer):
+        import asyncio
+        start = time.perf_counter()
+        self.requests += 1
+        try:
+            method, path, _ = (await reader.readline()).decode('latin-1').split(' ', 2)
+            headers = {}
+            while (line := await reader.readline()) not in (b'\r\n', b'\n', b''):
+                name, _, value = line.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get('content-length', 0)))
+        except (ValueError, asyncio.IncompleteReadError):
+            self.errors += 1
+            await self.respond(writer, 400, 'application/json', b'{"error": "Bad request"}')
+            return
+
+        path = path.split('?', 1)[0]
+        if path == '/metrics' and method == 'GET':
+            await self.respond(writer, 200, 'application/json', json.dumps(self.metrics(), indent=2).encode('utf-8'))
+        elif path == '/build' and method == 'POST':
+            try:
+                request = json.loads(body)
+                status, content_type, body, log, base_stats, rom_stats = \
+                    await asyncio.get_running_loop().run_in_executor(self.pool, serve_build, request)
+                self.base_cache.add_stats(base_stats)
+                self.rom_cache.add_stats(rom_stats)
+            except ValueError:
+                status, content_type, body, log = 400, 'application/json', b'{"error": "Invalid JSON"}', []
+            except Exception as e:
+                status, content_type, body, log = 500, 'application/json', json.dumps({'error': str(e)}).encode('utf-8'), []
+            self.builds += 1
+            if status != 200:
+                self.errors += 1
+            await self.respond(writer, status, content_type, body, {'X-PX41CX-Log': json.dumps(log)})
+            self.latency.append(time.perf_counter() - start)
+        else:
+            self.errors += 1
+            await self.respond(writer, 404 if path not in ('/build', '/metrics') else 405, 'application/json', b'{"error": "Not found"}')
+
+    async def respond(self, writer, status, content_type, body, headers={}):
+        from http import HTTPStatus
+        head = ["HTTP/1.1 {} {}".format(status, HTTPStatus(status).phrase), "Content-Type: " + content_type,
+                "Transfer-Encoding: chunked", "Connection: close"]
+        head += ["{}: {}".format(name, value) for name, value in headers.items()]
+        try:
+            writer.write(("\r\n".join(head) + "\r\n\r\n").encode('latin-1'))
+            for n in range(0, len(body), SERVE_CHUNK):
+                chunk = body[n:n + SERVE_CHUNK]
+                writer.write(b"%x\r\n" % len(chunk) + chunk + b"\r\n")
+                await writer.drain()
+            writer.write(b"0\r\n\r\n")
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    def metrics(self):
+        latency = sorted(self.latency)
+        def percentile(p):
+            return round(1000 * latency[min(int(p * len(latency)), len(latency) - 1)], 3) if latency else None
+        def cache(c):
+            lookups = c.hits + c.misses
+            return dict(c.stats(), hit_rate=round(c.hits / lookups, 4) if lookups else None)
+        return {'requests': self.requests, 'builds': self.builds, 'errors': self.errors,
+                'latency_ms': {'count': len(latency), 'mean': round(1000 * sum(latency) / len(latency), 3) if latency else None,
+                               'p50': percentile(0.5), 'p95': percentile(0.95), 'max': percentile(1)},
+                'base_cache': cache(self.base_cache), 'rom_cache': cache(self.rom_cache)}
+
+    async def start(self, host="127.0.0.1", port=8041, unix=None):
+        import asyncio
+        if unix:
+            return await asyncio.start_unix_server(self.handle, unix)
+        return await asyncio.start_server(self.handle, host, port)
+
+    async def serve(self, host="127.0.0.1", port=8041, unix=None):
+        server = await self.start(host, port, unix)
+        if unix:
+            print("Serving on", unix)
+        else:
+            print("Serving on http://{}:{}/".format(host, server.sockets[0].getsockname()[1]))
+        sys.stdout.flush()
+        async with server:
+            await server.serve_forever()
+
+    def close(self):
+        self.pool.shutdown()
+
+def serve_main(argv):
+    parser = argparse.ArgumentParser(prog='px41cx_utility.py serve', description='Build PX41CX firmware for HTTP requests.')
+    parser.add_argument('--host',type=str,default='127.0.0.1',help="Address to listen on (default 127.0.0.1)")
+    parser.add_argument('-p','--port',type=int,default=8041,help="Port to listen on (default 8041)")
+    parser.add_argument('--unix',type=str,metavar='PATH',help="Listen on a Unix socket instead")
+    parser.add_argument('--root',type=str,default='.',metavar='DIR',help="Directory the firmware, ROM, MOD and BMP file names are relative to")
+    parser.add_argument('-j','--jobs',type=int,default=1,help="Number of build processes")
+    parser.add_argument('--base-cache',type=int,default=32,metavar='MB',help="Memory for parsed base firmware in each worker (default 32)")
+    parser.add_argument('--rom-cache',type=int,default=16,metavar='MB',help="Memory for decoded ROMs in each worker (default 16)")
+    args = vars(parser.parse_args(argv))
+
+    import asyncio
+    server = BuildServer(args['root'], args['jobs'], args['base_cache'] * 1024 * 1024, args['rom_cache'] * 1024 * 1024)
+    try:
+        asyncio.run(server.serve(args['host'], args['port'], args['unix']))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+    return 0
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    try:
+        if argv and argv[0] == 'scan':
+            return scan_main(argv[1:])
+        if argv and argv[0] == 'library':
+            return library_main(argv[1:])
+        if argv and argv[0] == 'allocate':
+            return allocate_main(argv[1:])
+        if argv and argv[0] == 'extract':
+            return extract_main(argv[1:])
+        if argv and argv[0] == 'diff':
+            return diff_main(argv[1:])
+        if argv and argv[0] == 'patch':
+            return patch_main(argv[1:])
+        if argv and argv[0] == 'serve':
+            return serve_main(argv[1:])
+        return build_main(argv)
+    except PX41CXError as e:
+        print(e)
+        return 1
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,37 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'benchmarks'))
+import px41cx_utility as px
+import benchmark
+
+
+@pytest.mark.parametrize('version', ['0.902', '0.903'])
+def test_round_trip(tmp_path, version):
+    image = benchmark.make_firmware(version)
+    packed = {}
+    for n in (6, 11, 17):
+        romfile = str(tmp_path / 'R{}.ROM'.format(n))
+        benchmark.make_rom(romfile, n)
+        px.set_slot(image, n, romfile, 12, 1, 0, n, checksum='ignore')
+        with open(romfile, 'rb') as f:
+            packed[n] = px.decode_rom(f.read())
+
+    roms = {n: (name, rom) for n, name, rom in px.extract_roms(image)}
+    assert sorted(roms) == list(range(6, px.ROM_MAP_SIZE))
+    for n in packed:
+        assert roms[n][0].strip() == 'R{}'.format(n)
+        assert px.decode_rom(roms[n][1]) == packed[n]
+
+
+def test_os_locations_skipped(tmp_path):
+    image = benchmark.make_firmware('0.903')
+    assert all(px.get_rom(image, n)[0] != 255 for n in range(6))
+    assert all(n >= 6 for n, name, rom in px.extract_roms(image))
+    assert px.parse_slots("6,8-11") == [6, 8, 9, 10, 11]
+    for text in ("2", "0-7", "17-18"):
+        with pytest.raises(px.PX41CXError):
+            px.parse_slots(text)
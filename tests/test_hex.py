@@ -0,0 +1,56 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'benchmarks'))
+import px41cx_utility as px
+import benchmark
+
+
+@pytest.fixture(params=['0.902', '0.903'])
+def hexfile(request, tmp_path):
+    filename = str(tmp_path / 'fw.hex')
+    px.save_firmware(benchmark.make_firmware(request.param, 'fre'), filename)
+    px.DATE_OFFSETS.clear()
+    return filename
+
+
+def test_inspect_matches_full_read(hexfile):
+    full = px.read_hex(hexfile)
+    for _ in range(2):
+        image = px.read_hex(hexfile, px.INSPECT_REGIONS, True)
+        assert image.partial
+        for start, end in image.ranges:
+            assert image.data[start:end] == full.data[start:end]
+        assert px.inspect_firmware(hexfile) == px.inspect_firmware(hexfile, full)
+
+
+def test_known_date_offset_skips_low_area(hexfile):
+    px.inspect_firmware(hexfile)
+    image = px.read_hex(hexfile, px.INSPECT_REGIONS, True)
+    assert sum(end - start for start, end in image.ranges) < 1024
+    assert not image.used(px.ROM_LOCATION[0] - 16, px.ROM_LOCATION[0])
+    assert px.detect_firmware(image).language == 'fre'
+
+
+def test_unusual_files_fall_back(hexfile, tmp_path):
+    full = px.inspect_firmware(hexfile, px.read_hex(hexfile))
+    with open(hexfile) as f:
+        lines = f.read().splitlines(True)
+
+    crlf = tmp_path / 'crlf.hex'
+    crlf.write_bytes(''.join(lines).replace('\n', '\r\n').encode())
+    assert px.inspect_firmware(str(crlf))._replace(file=hexfile) == full
+
+    # Records out of address order within the regions are read whole
+    n = lines.index(next(l for l in lines if l.startswith(':10F800')))
+    swapped = tmp_path / 'swapped.hex'
+    swapped.write_text(''.join(lines[:n] + lines[n + 1:n + 2] + lines[n:n + 1] + lines[n + 2:]))
+    assert not px.read_hex(str(swapped), px.INSPECT_REGIONS, True).partial
+    assert px.inspect_firmware(str(swapped))._replace(file=hexfile) == full
+
+    lower = tmp_path / 'lower.hex'
+    lower.write_text(''.join(lines).lower())
+    assert px.inspect_firmware(str(lower))._replace(file=hexfile) == full
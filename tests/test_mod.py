@@ -0,0 +1,62 @@
+import os
+import random
+import struct
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import px41cx_utility as px
+
+
+def random_rom(seed):
+    rng = random.Random(seed)
+    return b''.join(rng.getrandbits(10).to_bytes(2, 'big') for _ in range(px.ROM_WORDS))
+
+
+def mod_image(rom):
+    # 4 words to 5 bytes, least significant bit first
+    words = struct.unpack('>4096H', rom)
+    return b''.join((words[i] | words[i + 1] << 10 | words[i + 2] << 20 | words[i + 3] << 30).to_bytes(5, 'little')
+                    for i in range(0, px.ROM_WORDS, 4))
+
+
+def write_mod(path, title, pages):
+    data = px.MOD_HEADER.pack(b'MOD1', title, b'1', b'', b'', b'', b'', b'', 0, 0, 0, 0, 1, 0, len(pages), b'')
+    for name, rom, placement, pagegroup, bank, bankgroup in pages:
+        data += px.MOD_PAGE.pack(name, b'', placement, pagegroup, bank, bankgroup, 0, 0, 1, mod_image(rom), b'')
+    path.write_bytes(data)
+    return str(path)
+
+
+def test_pages_and_banks(tmp_path):
+    roms = [random_rom(n) for n in range(3)]
+    filename = write_mod(tmp_path / 'adv.mod', b'ADVANTAGE', [(b'AdvU2', roms[2], 0x3f, 1, 2, 1),
+                                                            (b'AdvL1', roms[0], 0x2f, 1, 1, 1),
+                                                            (b'AdvU1', roms[1], 0x3f, 1, 1, 1)])
+    module = px.read_mod(filename)
+    assert module.name == 'ADVANTAGE'
+    assert [(p.placement, [r.name for r in p.roms]) for p in module.pages] == [('lower', ['AdvL1']), ('upper', ['AdvU1', 'AdvU2'])]
+    assert [r.packed for p in module.pages for r in p.roms] == [px.decode_rom(roms[n]) for n in (0, 1, 2)]
+
+    slots = px.allocate([module])[0]
+    assert [(a.slot, a.page, a.bank) for a in slots] == [(6, 8, 1), (7, 9, 1), (8, 9, 2)]
+    assert len(set(a.modgroup for a in slots)) == 1
+
+
+@pytest.mark.parametrize('code, placement, page', [(0x4f, 'even', 8), (0x5f, 'odd', 9), (0x1f, 'any', 8), (0x04, 4, 4)])
+def test_placements(tmp_path, code, placement, page):
+    module = px.read_mod(write_mod(tmp_path / 'one.mod', b'', [(b'ONE', random_rom(0), code, 0, 1, 0)]))
+    assert module.name == 'ONE'
+    assert module.pages[0].placement == placement
+    assert px.allocate([module])[0][0].page == page
+
+
+def test_bad_files(tmp_path):
+    with pytest.raises(px.PX41CXError):
+        px.read_mod(write_mod(tmp_path / 'bank.mod', b'', [(b'X2', random_rom(0), 0x1f, 0, 2, 0)]))
+    (tmp_path / 'short.mod').write_bytes(b'MOD1' + bytes(100))
+    with pytest.raises(px.PX41CXError):
+        px.read_mod(str(tmp_path / 'short.mod'))
+    with pytest.raises(px.PX41CXError):
+        px.read_mod(str(tmp_path / 'missing.mod'))
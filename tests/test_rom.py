@@ -0,0 +1,106 @@
+import os
+import random
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import px41cx_utility as px
+
+
+def loop_decode(rom):
+    # The original per-word decoder
+    barr = bytearray(px.PACKED_SIZE)
+    loc = 0
+    for x in range(256):
+        for y in range(0, 32, 2):
+            barr[loc] = rom[x * 32 + y + 1]
+            loc += 1
+    for x in range(64):
+        for y in range(0, 128, 8):
+            high = (rom[x * 128 + y + 6] & 3) << 6
+            high |= (rom[x * 128 + y + 4] & 3) << 4
+            high |= (rom[x * 128 + y + 2] & 3) << 2
+            high |= (rom[x * 128 + y + 0] & 3)
+            barr[loc] = high
+            loc += 1
+    return bytes(barr)
+
+
+def random_rom(seed):
+    rng = random.Random(seed)
+    return b''.join(rng.getrandbits(10).to_bytes(2, 'big') for _ in range(px.ROM_WORDS))
+
+
+@pytest.fixture(params=['pure', 'numpy'])
+def path(request, monkeypatch):
+    if request.param == 'numpy':
+        pytest.importorskip('numpy')
+        px.have_numpy()
+    else:
+        monkeypatch.setattr(px, 'numpy', False)
+    return request.param
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_decode_matches_loop(path, seed):
+    rom = random_rom(seed)
+    assert px.decode_rom(rom) == loop_decode(rom)
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_round_trip(path, seed):
+    rom = random_rom(seed)
+    packed = px.decode_rom(rom)
+    assert px.encode_rom(packed) == rom
+    assert px.decode_rom(px.encode_rom(packed)) == packed
+
+
+def test_decode_ignores_unused_high_bits(path):
+    rom = bytearray(random_rom(0))
+    rom[0::2] = bytes(b | 0xfc for b in rom[0::2])
+    assert px.decode_rom(bytes(rom)) == loop_decode(rom)
+
+
+def test_short_rom(path):
+    with pytest.raises(ValueError):
+        px.decode_rom(bytes(px.ROM_FILE_SIZE - 1))
+    with pytest.raises(ValueError):
+        px.encode_rom(bytes(px.PACKED_SIZE - 1))
+
+
+def test_checksum(path):
+    packed = bytearray(px.decode_rom(random_rom(1)))
+    px.fix_rom_checksum(packed)
+    assert px.rom_word(packed, px.ROM_WORDS - 1) == px.rom_checksum(packed)
+    total = 0
+    for n in range(px.ROM_WORDS - 1):
+        total += px.rom_word(packed, n)
+        if total > 0x3ff:
+            total = (total & 0x3ff) + 1
+    assert px.rom_word(packed, px.ROM_WORDS - 1) == -total & 0x3ff
+    assert px.check_rom(packed) in ([], ["bad header"])
+
+
+@pytest.mark.parametrize('checksum, problem', [('warn', "bad length"), ('fix', "fixed length"), ('ignore', None), ('error', None)])
+def test_long_rom_file(tmp_path, checksum, problem):
+    packed = bytearray(px.decode_rom(random_rom(2)))
+    px.fix_rom_checksum(packed)
+    romfile = tmp_path / 'LONG.ROM'
+    romfile.write_bytes(px.encode_rom(packed) + bytes(16))
+
+    image = px.FirmwareImage()
+    if checksum == 'error':
+        with pytest.raises(px.PX41CXError, match="bad length"):
+            px.set_slot(image, 6, str(romfile), 12, 1, 0, 0, checksum=checksum)
+        return
+    problems = px.set_slot(image, 6, str(romfile), 12, 1, 0, 0, checksum=checksum)
+    assert [p for p in problems if p != "bad header"] == ([problem] if problem else [])
+    assert image.gets(px.ROM_LOCATION[6], px.PACKED_SIZE) == packed
+
+    info = px.rom_info(str(romfile))
+    assert "bad length" in info['problems'] and info['checksum']
+    library = px.RomLibrary(str(tmp_path / 'library.db'))
+    library.refresh([str(tmp_path)])
+    assert "bad length" in library.find()[0]['problems']
+    library.close()
@@ -0,0 +1,144 @@
+import asyncio
+import json
+import os
+import sys
+import threading
+import urllib.error
+import urllib.request
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'benchmarks'))
+import px41cx_utility as px
+import benchmark
+
+
+@pytest.fixture
+def root(tmp_path):
+    root = tmp_path / 'root'
+    root.mkdir()
+    px.save_firmware(benchmark.make_firmware('0.903'), str(root / 'base.hex'))
+    benchmark.make_rom(str(root / 'A.ROM'), 1)
+    benchmark.make_bmp(str(root / 'splash.bmp'), 4)
+    benchmark.make_rom(str(tmp_path / 'OUTSIDE.ROM'), 2)
+    return root
+
+
+@pytest.fixture
+def url(root):
+    server = px.BuildServer(str(root))
+    loop = asyncio.new_event_loop()
+    listener = loop.run_until_complete(server.start('127.0.0.1', 0))
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    yield "http://127.0.0.1:{}/".format(listener.sockets[0].getsockname()[1])
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+    listener.close()
+    loop.run_until_complete(listener.wait_closed())
+    loop.close()
+    server.close()
+
+
+def post(url, body):
+    data = body if isinstance(body, bytes) else json.dumps(body).encode('utf-8')
+    try:
+        with urllib.request.urlopen(urllib.request.Request(url + 'build', data)) as f:
+            return f.status, f.read()
+    except urllib.error.HTTPError as e:
+        return e.code, json.loads(e.read())['error']
+
+
+def fresh_build(root, tmp_path, request, outfile):
+    args = px.manifest_args(dict(request, outfile=outfile), str(root))
+    image = px.load_firmware(str(root / request['base']))
+    px.build_firmware(image, args)
+    px.save_firmware(image, outfile)
+    with open(outfile, 'rb') as f:
+        return f.read()
+
+
+def test_build_hex_and_bin(root, url, tmp_path):
+    request = {'base': 'base.hex', 'roms': {'06': ['A.ROM', 'c', 1, 0, 10]}, 'user': ['Served'], 'bmpfile': 'splash.bmp'}
+    status, body = post(url, request)
+    assert status == 200
+    assert body == fresh_build(root, tmp_path, request, str(tmp_path / 'fresh.hex'))
+    assert post(url, request) == (200, body)
+
+    status, body = post(url, dict(request, format='bin'))
+    assert status == 200
+    assert body == fresh_build(root, tmp_path, request, str(tmp_path / 'fresh.bin'))
+
+
+@pytest.mark.parametrize('request_body, error', [
+    ({}, "without base"),
+    ({'base': 'missing.hex'}, "Error opening firmware file"),
+    ({'base': 'base.hex', 'format': 'txt'}, "Invalid format"),
+    ({'base': 'base.hex', 'roms': {'06': ['A.ROM', 'c']}}, "Invalid manifest ROM entry"),
+    ({'base': 'base.hex', 'roms': {'06': ['A.ROM', '5', 1, 0, 10]}}, "OS page"),
+    (b'{not json', "Invalid JSON"),
+])
+def test_bad_requests(url, request_body, error):
+    status, message = post(url, request_body)
+    assert status == 400
+    assert error in message
+
+
+@pytest.mark.parametrize('field', ['base', 'rom', 'mod', 'bmp'])
+@pytest.mark.parametrize('name', ['../OUTSIDE.ROM', 'ABSOLUTE'])
+def test_paths_outside_root(root, url, field, name):
+    if name == 'ABSOLUTE':
+        name = str(root.parent / 'OUTSIDE.ROM')
+    request = {'base': 'base.hex'}
+    if field == 'base':
+        request['base'] = name
+    elif field == 'rom':
+        request['roms'] = {'06': [name, 'c', 1, 0, 10]}
+    elif field == 'mod':
+        request['mods'] = [name]
+    else:
+        request['bmpfile'] = name
+    status, message = post(url, request)
+    assert status == 400
+    assert "outside the server root" in message
+
+
+def test_metrics(url):
+    post(url, {'base': 'base.hex', 'user': ['One']})
+    post(url, {'base': 'base.hex', 'user': ['Two']})
+    post(url, {'base': 'missing.hex'})
+    with urllib.request.urlopen(url + 'metrics') as f:
+        metrics = json.loads(f.read())
+    assert metrics['builds'] == 3
+    assert metrics['errors'] == 1
+    assert metrics['latency_ms']['count'] == 3
+    assert metrics['base_cache']['hits'] == 1
+    assert metrics['base_cache']['misses'] == 1
+
+    with pytest.raises(urllib.error.HTTPError) as e:
+        urllib.request.urlopen(url + 'nothing')
+    assert e.value.code == 404
+
+
+def test_unix_socket(root, tmp_path):
+    if not hasattr(asyncio, 'start_unix_server'):
+        pytest.skip("no Unix sockets")
+    path = str(tmp_path / 'px.sock')
+    server = px.BuildServer(str(root))
+
+    async def exchange():
+        listener = await server.start(unix=path)
+        reader, writer = await asyncio.open_unix_connection(path)
+        writer.write(b"GET /metrics HTTP/1.1\r\nHost: localhost\r\n\r\n")
+        response = await reader.read()
+        listener.close()
+        await listener.wait_closed()
+        return response
+
+    try:
+        response = asyncio.run(exchange())
+    finally:
+        server.close()
+    assert response.startswith(b"HTTP/1.1 200 OK")
+    assert b'"requests": 1' in response
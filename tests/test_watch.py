@@ -0,0 +1,113 @@
+import json
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'benchmarks'))
+import px41cx_utility as px
+import benchmark
+
+SCRIPT = os.path.join(os.path.dirname(__file__), '..', 'px41cx_utility.py')
+
+
+def touch(path, step):
+    t = time.time() + step
+    os.utime(path, (t, t))
+
+
+def write_manifest(path, variants, step):
+    with open(path, "w") as f:
+        json.dump({'variants': variants}, f)
+    touch(path, step)
+
+
+@pytest.fixture
+def files(tmp_path):
+    px.save_firmware(benchmark.make_firmware('0.902'), str(tmp_path / 'base.hex'))
+    benchmark.make_rom(str(tmp_path / 'A.ROM'), 1)
+    benchmark.make_rom(str(tmp_path / 'B.ROM'), 2)
+    benchmark.make_bmp(str(tmp_path / 'splash.bmp'), 4)
+    benchmark.make_bmp(str(tmp_path / 'complex.bmp'), 1500, 4)
+    return tmp_path
+
+
+class Watcher:
+    def __init__(self, directory, args):
+        self.process = subprocess.Popen([sys.executable, SCRIPT, 'base.hex'] + args + ['--watch', '--interval', '0.02'],
+                                        cwd=str(directory), stdout=subprocess.PIPE, text=True)
+        self.wait_for("Watching")
+
+    def wait_for(self, text):
+        lines = []
+        while True:
+            line = self.process.stdout.readline()
+            assert line, "watch stopped: " + "".join(lines)
+            lines.append(line)
+            if text in line:
+                return lines
+
+    def stop(self):
+        self.process.terminate()
+        self.process.wait()
+
+
+def fresh(directory, variant):
+    with open(str(directory / 'one.json'), "w") as f:
+        json.dump({'variants': [dict(variant, outfile='fresh.hex')]}, f)
+    subprocess.run([sys.executable, SCRIPT, 'base.hex', '--manifest', 'one.json'], cwd=str(directory),
+                   stdout=subprocess.DEVNULL, check=True)
+    return (directory / 'fresh.hex').read_bytes()
+
+
+def test_manifest_changes(files):
+    variant = {'outfile': 'out.hex', 'roms': {'06': ['A.ROM', 'c', 1, 0, 10]}, 'user': ['One'], 'language': 'eng',
+               'bmpfile': 'splash.bmp'}
+    write_manifest(str(files / 'm.json'), [variant], 1)
+    watcher = Watcher(files, ['--manifest', 'm.json'])
+    try:
+        assert (files / 'out.hex').read_bytes() == fresh(files, variant)
+
+        variant.update(user=['Two', 'Three'], language='fre')
+        write_manifest(str(files / 'm.json'), [variant], 2)
+        assert "(language,user)" in watcher.wait_for("Rebuilt")[-1]
+        assert (files / 'out.hex').read_bytes() == fresh(files, variant)
+
+        # A splash screen that does not fit leaves the infile splash screen, as a fresh build does
+        variant['bmpfile'] = 'complex.bmp'
+        write_manifest(str(files / 'm.json'), [variant], 3)
+        assert "(all)" in watcher.wait_for("Rebuilt")[-1]
+        assert (files / 'out.hex').read_bytes() == fresh(files, variant)
+
+        variant['roms']['06'][0] = 'B.ROM'
+        write_manifest(str(files / 'm.json'), [variant], 4)
+        assert "(rom06)" in watcher.wait_for("Rebuilt")[-1]
+        assert (files / 'out.hex').read_bytes() == fresh(files, variant)
+    finally:
+        watcher.stop()
+
+
+def test_input_file_changes(files):
+    args = ['out.hex', '-06', 'A.ROM', 'c', '1', '0', '10', '-b', 'splash.bmp', '-u1', 'Watch']
+    variant = {'outfile': 'out.hex', 'roms': {'06': ['A.ROM', 'c', 1, 0, 10]}, 'user': ['Watch'], 'bmpfile': 'splash.bmp'}
+    watcher = Watcher(files, args)
+    try:
+        benchmark.make_rom(str(files / 'A.ROM'), 3)
+        touch(str(files / 'A.ROM'), 1)
+        assert "(rom06)" in watcher.wait_for("Rebuilt")[-1]
+        assert (files / 'out.hex').read_bytes() == fresh(files, variant)
+
+        benchmark.make_bmp(str(files / 'splash.bmp'), 6, seed=2)
+        touch(str(files / 'splash.bmp'), 2)
+        assert "(splash)" in watcher.wait_for("Rebuilt")[-1]
+        assert (files / 'out.hex').read_bytes() == fresh(files, variant)
+
+        (files / 'splash.bmp').write_bytes((files / 'complex.bmp').read_bytes())
+        touch(str(files / 'splash.bmp'), 3)
+        assert "(all)" in watcher.wait_for("Rebuilt")[-1]
+        assert (files / 'out.hex').read_bytes() == fresh(files, variant)
+    finally:
+        watcher.stop()